@@ -2,20 +2,24 @@
 
 """
 Collect data from InfiniBand devices. 
-!!! This plugin resets the InfiniBand counters, when initialized!!!
+Extended 64 bit counters are used, if available. 32 bit counters are reset 
+with perfquery, only if they saturate.
 
 by Robert Dietrich (robert.dietrich@tu-dresden.de) for the ProPE project
 
 #### Dependencies
 
- * [subprocess](http://docs.python.org/library/subprocess.html)
+ * [subprocess](http://docs.python.org/library/subprocess.html) (perfquery)
 """
 
 import time
 import os
 import sys
+import math
 import subprocess
 import re
+import socket
+import threading
 
 try:
   import collectd
@@ -23,9 +27,6 @@ except ImportError:
   import dummy_collectd as collectd
   collectd.info("Using dummy collectd for testing")
 
-# get available file systems
-from subprocess import Popen, PIPE, STDOUT
-
 ### global variables ###
 directory = "/sys/class/infiniband"
 devices = None
@@ -36,14 +37,103 @@ recheck_limit = 0 # number of intervals/collects after re-checking the available
 
 ibPortList = []
 
-# values of previous counter read
-recv_prev = sys.maxsize
-send_prev = sys.maxsize
+# dispatch bytes, packets, packet size and congestion per port and direction
+perPort = False
+
+# time stamp of previous counter read
 time_prev = 0
 
 perfquery_filepath = "/usr/sbin/perfquery"
+
+# check the IB files on device hotplug events (replaces the periodic checks)
+watchDevices = True
+watcherThread = None
+watcherRunning = False
+
+# protects the port list, which is changed by the device watcher
+portLock = threading.Lock()
+
+# read the data counters every samplePeriod seconds in a background thread and
+# dispatch peak, 95th percentile and time above burstThreshold at each read
+samplePeriod = 0
+burstThreshold = 0 # bytes per second (0: no time above threshold)
+samplerThread = None
+samplerStop = threading.Event()
+
+# (duration, bandwidth) of the samples in the current interval, protected by samplerLock
+samples = []
+samplerLock = threading.Lock()
 ### END: global variables ###
 
+# kernel uevents (netlink protocol and multicast group)
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+
+# seconds to wait after a hotplug event for further events
+HOTPLUG_SETTLE_TIME = 1
+
+# data counters of a port (octets divided by 4 lanes)
+DATA_COUNTERS = ('port_rcv_data', 'port_xmit_data')
+
+# additional counters of a port for the per-port values
+PORT_COUNTERS = ('port_rcv_packets', 'port_xmit_packets', 'port_xmit_wait', 
+                 'port_xmit_discards', 'port_rcv_errors', 'symbol_error')
+
+# data sources of the multi-value type 'ib_port' (see custom_types.db)
+PORT_TYPE = 'ib_port'
+
+# 32 bit counters stop at their maximum value (they do not wrap)
+COUNTER_MAX_32 = 4294967295
+
+# the error counters have only 16 bit
+COUNTER_MAX_16 = {'port_xmit_discards': 65535, 'port_rcv_errors': 65535, 'symbol_error': 65535}
+
+# saturated counters, for which the port is reset (last resort), other saturated 
+# counters (congestion, errors) are reported and have no rate
+RESET_COUNTERS = DATA_COUNTERS + ('port_rcv_packets', 'port_xmit_packets')
+
+# 64 bit counters wrap, a smaller value than before is a wrap, if the previous 
+# value was in the upper half of the range (otherwise a reset)
+COUNTER_MAX_64 = 2**64
+COUNTER_WRAP_THRESHOLD = 2**63
+
+"""
+Counter files and previous values of an InfiniBand port.
+"""
+class _IBPort(object):
+  __slots__ = ('path', 'device', 'port', 'files', 'previous', 'wide', 'saturated', 'template')
+
+  def __init__(self, path):
+    self.path = path # e.g. /sys/class/infiniband/mlx4_0/ports/1
+    self.device = os.path.basename(os.path.dirname(os.path.dirname(path)))
+    self.port = os.path.basename(path)
+    self.files = {}    # counter name -> counter file
+    self.previous = {} # counter name -> last value
+    self.wide = set()  # counters with 64 bit
+    self.saturated = set() # saturated counters, which are not reset
+    self.template = None # value list of type 'ib_port' (perPort)
+
+  """
+  Use the extended 64 bit counter files (counters_ext/<counter>_64), if 
+  available, and the files in 'counters' otherwise. Their width depends on 
+  the driver. They are assumed to be 64 bit, once they exceed 32 bit (16 bit for
+  error counters). Counters other than the data counters are optional (not 
+  every driver provides them) and only used, if their file exists.
+  """
+  def setupCounters(self, counters):
+    for counter in counters:
+      extFile = os.path.join(self.path, 'counters_ext', counter + '_64')
+      if os.path.isfile(extFile):
+        self.files[counter] = extFile
+        self.wide.add(counter)
+        continue
+
+      counterFile = os.path.join(self.path, 'counters', counter)
+      if counter in DATA_COUNTERS or os.path.isfile(counterFile):
+        self.files[counter] = counterFile
+      else:
+        collectd.debug("ib_bw plugin: No counter %s for %s" % (counter, self.path))
+
 ### utility functions
 def is_exe(fpath):
   return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
@@ -62,26 +152,43 @@ def which(program):
   return None
 ##################### 
 
-# reset counters, if perfquery is available
-def _reset_counters():
-  if perfquery_filepath:
-    collectd.debug("ib_bw plugin: Reset counters!")
-    try:
-      proc = subprocess.Popen([perfquery_filepath], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-      (out, err) = proc.communicate()
-    except subprocess.CalledProcessError as e:
-      collectd.info("ib_bw plugin: %s error launching: %s; skipping" % (perfquery_filepath, e))
-      return -1
-    else:
-      if proc.returncode:
-        collectd.error("ib_bw plugin: %s return exit value %s; skipping" % (perfquery_filepath, proc.returncode))
-        return -1
-      if err:
-        collectd.error("ib_bw plugin: %s return error output: %s" % (perfquery_filepath, err))
-        return -1
-  else:
-    collectd.info("ib_bw plugin: Cannot reset counters!" )
-    
+"""
+Reset the (32 and 16 bit) counters of a port with perfquery, which is only required, 
+if a data or packet counter saturated. Return 0 on success and -1 otherwise.
+"""
+def _reset_counters(ibPort):
+  if not perfquery_filepath:
+    collectd.info("ib_bw plugin: Cannot reset counters of %s!" % (ibPort.path,))
+    return -1
+
+  collectd.debug("ib_bw plugin: Reset counters of %s!" % (ibPort.path,))
+  cmd = [perfquery_filepath, '-R', '-C', ibPort.device, '-P', ibPort.port]
+  try:
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = proc.communicate()
+  except OSError as e:
+    collectd.info("ib_bw plugin: %s error launching: %s; skipping" % (perfquery_filepath, e))
+    return -1
+
+  if proc.returncode:
+    collectd.error("ib_bw plugin: %s return exit value %s; skipping" % (' '.join(cmd), proc.returncode))
+    return -1
+  if err:
+    collectd.error("ib_bw plugin: %s return error output: %s" % (' '.join(cmd), err))
+    return -1
+
+  return 0
+
+"""
+Return the paths of the subdirectories of a directory sorted by name (or an
+empty list, if the directory cannot be read).
+"""
+def _listDirectories(path):
+  try:
+    return sorted(entry.path for entry in os.scandir(path) if entry.is_dir())
+  except OSError:
+    return []
+
 """
 brief Determine the files and paths where the IB counters are read from. 
 Find infiniband devices, if they have not been specified in the collectd.conf. 
@@ -98,24 +205,16 @@ def _setupSourcefiles():
       collectd.error("ib_bw plugin: Infiniband directory %s does not exist!" % (directory,))
       return
 
-    # find all infiniband devices
-    cmd = "find " + directory + "/* -maxdepth 0"
-    try:
-      p = Popen( cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE )
-      detectedDevices, stderr = p.communicate()
-    except subprocess.CalledProcessError as e:
-      collectd.info("ib_bw plugin: %s; Error launching '%s'! Disable plugin." % (repr(e), cmd))
-      return
-    else:
-      detectedDevices = detectedDevices.decode('utf-8')
-      ibDevices = filter( None, detectedDevices.split('\n') )
+    # find all infiniband devices (entries are links to the device directories)
+    ibDevices = _listDirectories( directory )
   else:
     # devices from collectd.conf are a comma-separated list
     ibDevices = devices.split(',')
 
-  # find ports for all devices and add them to the list
+  # find ports for all devices and add them to the list (keep known ports)
   global ibPortList
-  ibPortList = []
+  knownPorts = dict((ibPort.path, ibPort) for ibPort in ibPortList)
+  portList = []
   for ibDevice in ibDevices:
     if not os.path.isdir( ibDevice + "/ports" ):
       collectd.info("ib_bw plugin: No ports for device %s found" % (ibDevice,))
@@ -123,24 +222,19 @@ def _setupSourcefiles():
 
     collectd.debug("ib_bw plugin: Found device with ports: " + ibDevice)
 
-    cmd = "find " + ibDevice + "/ports/* -maxdepth 0 -type d 2>/dev/null"
-    try:
-      p = Popen( cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE )
-      ibDevicePorts, stderr = p.communicate()
-    except subprocess.CalledProcessError as e:
-      collectd.info("ib_bw plugin: %s error launching: %s; Disable plugin." % (repr(e), cmd))
-      return
-    else:
-      ibDevicePorts = ibDevicePorts.decode('utf-8')
-      
-    for ibDevicePort in filter( None, ibDevicePorts.split('\n') ):
+    for ibDevicePort in _listDirectories( ibDevice + "/ports" ):
       if not os.path.isdir( ibDevicePort + "/counters" ):
         collectd.info("ib_bw plugin: No counters for device port %s found." % (ibDevicePort,))
         continue
 
-      ibPortList.append( ibDevicePort )
+      ibPort = knownPorts.get( ibDevicePort )
+      if ibPort is None:
+        ibPort = _IBPort( ibDevicePort )
+        ibPort.setupCounters( DATA_COUNTERS + PORT_COUNTERS if perPort else DATA_COUNTERS )
+      portList.append( ibPort )
       collectd.debug("ib_bw plugin: Found port with counters: " + ibDevicePort)
 
+  ibPortList = portList
   if len(ibPortList) == 0:
     collectd.info("ib_bw plugin: No devices/ports found!" )
   else:
@@ -154,9 +248,229 @@ def _read_counter(file):
   except IOError as ioe:
     collectd.error("ib_bw plugin: Cannot read %s (%s)" % (file, repr(ioe)) )
   else:
-    return float(finput)
+    return int(finput)
+
+  return -1
 
-  return float(-1)
+"""
+Return the increase of a counter since the previous value. After a reset the 
+counter started again at zero, hence the current value is the increase.
+"""
+def _counter_delta(current, previous, wide):
+  if current >= previous:
+    return current - previous
+  elif wide and previous >= COUNTER_WRAP_THRESHOLD:
+    return current + COUNTER_MAX_64 - previous
+  else:
+    return current
+
+"""
+Read the counters of a port. Return a dictionary of counter name -> increase 
+since the previous read (without counters read the first time, saturated 
+congestion and error counters and optional counters that cannot be read) or 
+None, if a data counter cannot be read. Saturated 
+32 bit data and packet counters are reset (last resort), the increase up to 
+the saturation is still counted.
+"""
+def _read_port(ibPort):
+  deltas = {}
+  saturated = False
+  for counter, path in ibPort.files.items():
+    value = _read_counter(path)
+    if value < 0:
+      if counter in DATA_COUNTERS:
+        return None
+      continue
+
+    limit = COUNTER_MAX_16.get(counter, COUNTER_MAX_32)
+    if value > limit:
+      ibPort.wide.add(counter)
+    elif value == limit and counter not in ibPort.wide:
+      if counter in RESET_COUNTERS:
+        saturated = True
+      else:
+        # e.g. symbol errors of a bad link, keep the counter for fabric tools
+        if counter not in ibPort.saturated:
+          ibPort.saturated.add(counter)
+          collectd.warning("ib_bw plugin: %s of %s is saturated (%d)." % (counter, ibPort.path, value))
+        ibPort.previous[counter] = value
+        continue
+    else:
+      ibPort.saturated.discard(counter)
+
+    if counter in ibPort.previous:
+      deltas[counter] = _counter_delta(value, ibPort.previous[counter], counter in ibPort.wide)
+    ibPort.previous[counter] = value
+
+  # perfquery resets the 32 and 16 bit counters of the port
+  if saturated and _reset_counters(ibPort) == 0:
+    for counter in ibPort.files:
+      if counter not in ibPort.wide:
+        ibPort.previous[counter] = 0
+
+  return deltas
+
+"""
+Dispatch the rates of a port (bytes and packets per direction, average packet 
+size in bytes, congestion and errors) as one value list of type 'ib_port'.
+"""
+def _dispatch_port(ibPort, deltas, interval, timestamp):
+  rcv = deltas.get('port_rcv_data', 0) * 4
+  xmit = deltas.get('port_xmit_data', 0) * 4
+  rcvPackets = deltas.get('port_rcv_packets', float('nan'))
+  xmitPackets = deltas.get('port_xmit_packets', float('nan'))
+
+  vl = ibPort.template
+  if vl is None:
+    vl = collectd.Values(type=PORT_TYPE)
+    vl.plugin = 'infiniband'
+    vl.plugin_instance = ibPort.device + '-' + ibPort.port
+    ibPort.template = vl
+
+  # saturated and missing (optional) counters have no rate (NaN)
+  vl.values = [rcv / interval, 
+               xmit / interval,
+               rcvPackets / interval,
+               xmitPackets / interval,
+               float(rcv) / rcvPackets if rcvPackets > 0 else float('nan'),
+               float(xmit) / xmitPackets if xmitPackets > 0 else float('nan'),
+               deltas.get('port_xmit_wait', float('nan')) / interval,
+               deltas.get('port_xmit_discards', float('nan')) / interval,
+               deltas.get('port_rcv_errors', float('nan')) / interval,
+               deltas.get('symbol_error', float('nan')) / interval]
+  vl.time = timestamp
+  vl.dispatch()
+
+"""
+Wait for kernel uevents of the subsystem 'infiniband' (devices added or 
+removed, e.g. driver reload) and check the IB files then.
+"""
+def _watchDevices(sock):
+  while watcherRunning:
+    try:
+      message = sock.recv(16384)
+    except socket.timeout:
+      continue
+    except (OSError, socket.error) as ex:
+      collectd.error("ib_bw plugin: Stop watching devices (%s)" % (repr(ex),))
+      break
+
+    # '<action>@<devpath>\0KEY=value\0...'
+    fields = message.split(b'\0')
+    if b'SUBSYSTEM=infiniband' not in fields[1:]:
+      continue
+
+    # hotplug events come in bursts, read them all
+    time.sleep(HOTPLUG_SETTLE_TIME)
+    sock.settimeout(0)
+    try:
+      while sock.recv(16384):
+        pass
+    except (OSError, socket.error):
+      pass
+    sock.settimeout(1)
+
+    collectd.info("ib_bw plugin: InfiniBand devices changed (%s). Check IB files." % (fields[0].decode('utf-8', 'replace'),))
+    with portLock:
+      _setupSourcefiles()
+
+  sock.close()
+
+"""
+Start the device watcher thread on a netlink socket for kernel uevents.
+"""
+def _startWatcher():
+  global watcherThread
+  global watcherRunning
+  try:
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+    sock.bind((0, UEVENT_GROUP_KERNEL))
+    sock.settimeout(1) # notice the end of the plugin
+  except (AttributeError, OSError, socket.error) as ex:
+    collectd.info("ib_bw plugin: Cannot watch devices (%s). Use recheck_limit for periodic checks." % (repr(ex),))
+    return
+
+  watcherRunning = True
+  watcherThread = threading.Thread(target=_watchDevices, args=(sock,), name='ib_bw devices')
+  watcherThread.daemon = True
+  watcherThread.start()
+
+"""
+Read the data counters of all ports every samplePeriod seconds and store the 
+bandwidth (receive and transmit) since the previous sample. The previous 
+values of the sampler are separate from those of the read callback.
+"""
+def _sampleLoop():
+  previous = {} # counter file -> last value
+  timePrev = 0
+  while not samplerStop.is_set():
+    start = time.monotonic()
+    with portLock:
+      ports = list(ibPortList)
+
+    total = 0
+    current = {}
+    for ibPort in ports:
+      for counter in DATA_COUNTERS:
+        path = ibPort.files[counter]
+        try:
+          with open(path, 'r') as f:
+            value = int(f.read())
+        except (IOError, ValueError):
+          continue
+
+        current[path] = value
+        if path in previous:
+          total += _counter_delta(value, previous[path], counter in ibPort.wide)
+
+    now = time.monotonic()
+    if timePrev > 0 and now > timePrev:
+      with samplerLock:
+        samples.append((now - timePrev, total * 4 / (now - timePrev)))
+    previous = current
+    timePrev = now
+
+    samplerStop.wait(max(0, samplePeriod - (time.monotonic() - start)))
+
+"""
+Dispatch peak and 95th percentile of the sampled bandwidths of the interval 
+and the seconds above burstThreshold (e.g. 'bw_max') and start the next interval.
+"""
+def _dispatch_sample_summaries(timestamp):
+  global samples
+  with samplerLock:
+    current = samples
+    samples = []
+
+  if not current:
+    return
+
+  rates = sorted(rate for duration, rate in current)
+  summary = {
+    'max': rates[-1],
+    'p95': rates[max(0, int(math.ceil(0.95 * len(rates))) - 1)]
+  }
+  if burstThreshold > 0:
+    summary['burst_time'] = sum(duration for duration, rate in current if rate > burstThreshold)
+
+  for name, value in summary.items():
+    vl = collectd.Values(type='gauge')
+    vl.plugin = 'infiniband'
+    vl.values = [float(value)]
+    vl.time = timestamp
+    vl.type_instance = 'bw_' + name
+    vl.dispatch()
+
+"""
+Start the high-frequency sampler thread.
+"""
+def _startSampler():
+  global samplerThread
+  samplerStop.clear()
+  samplerThread = threading.Thread(target=_sampleLoop, name='ib_bw sampler')
+  samplerThread.daemon = True
+  samplerThread.start()
+  collectd.info("ib_bw plugin: Sample bandwidth every %gs" % (samplePeriod,))
 
 def ib_plugin_config(config):
   if config.values[0] == 'ib_bw':
@@ -170,6 +484,18 @@ def ib_plugin_config(config):
         global devices
         devices = value.values[0]
         collectd.info("ib_bw plugin: Use ib_devices %s from config file" % (devices,))
+      elif value.key == 'per_port':
+        global perPort
+        perPort = value.values[0] in (True, 'true', 'True', '1')
+      elif value.key == 'watch_devices':
+        global watchDevices
+        watchDevices = value.values[0] in (True, 'true', 'True', '1')
+      elif value.key == 'sample_period':
+        global samplePeriod
+        samplePeriod = float(value.values[0])
+      elif value.key == 'burst_threshold':
+        global burstThreshold
+        burstThreshold = float(value.values[0])
       elif value.key == 'recheck_limit':
         global recheck_limit
         recheck_limit = int(value.values[0])
@@ -186,27 +512,44 @@ def ib_plugin_initialize():
     perfquery_filepath = which("perfquery")
 
   if perfquery_filepath:
-    collectd.debug("ib_bw plugin: %s is available to reset counters" % (perfquery_filepath,))
-
-    # add -R option to reset counters
-    perfquery_filepath += " -R"
-
-  # initial reset of IB counters
-  _reset_counters()
+    collectd.debug("ib_bw plugin: %s is available to reset saturated counters" % (perfquery_filepath,))
   
   # determine the paths to the IB counter files
   _setupSourcefiles()
 
+  if watchDevices and devices == None:
+    _startWatcher()
+
+  if samplePeriod > 0:
+    _startSampler()
+
+"""
+Collectd plugin shutdown callback. Stops the device watcher and the sampler.
+"""
+def ib_plugin_shutdown():
+  global watcherRunning
+  watcherRunning = False
+  if watcherThread:
+    watcherThread.join(2)
+
+  samplerStop.set()
+  if samplerThread:
+    samplerThread.join(2)
 
 """
 brief Read send and receive counters from Infiniband devices
 """
 def ib_plugin_read(data=None):
-  # check for available IB files every #recheck_limit reads
+  with portLock:
+    _read()
+
+def _read():
+  # check for available IB files every #recheck_limit reads (not needed, if 
+  # devices are watched)
   global num_reads
   num_reads += 1
   
-  if num_reads == recheck_limit: 
+  if num_reads == recheck_limit and not watcherRunning: 
     _setupSourcefiles()
     num_reads = 0
 
@@ -217,64 +560,43 @@ def ib_plugin_read(data=None):
   recv = 0
   send = 0
 
-  overflow = False
   value_error = False
 
   # one time stamp for all IB metrics
+  global time_prev
   timestamp = time.time()
+  interval = timestamp - time_prev if time_prev > 0 else 0
 
   # iterate over all ports (of all devices)
   for ibPort in ibPortList:
-    # Total number of data octets, divided by 4 (lanes), transmitted/receied on 
-    # all VLs. This seems to be a 32 bit unsigned counter.
-
-    # get port receive data
-    counter_value = _read_counter(ibPort + "/counters/port_rcv_data")
-    if counter_value < 0:
-      value_error = True
-    else:
-      # check if counter value stops at 32 bit and reset it
-      if counter_value == 4294967295:
-        overflow = True
-      else:
-        recv += counter_value * 4
-
-    # get port send data
-    counter_value = _read_counter(ibPort + "/counters/port_xmit_data")
-    if counter_value < 0:
+    deltas = _read_port(ibPort)
+    if deltas is None:
       value_error = True
-    else:
-      # check if counter value stops at 32 bit and reset it
-      if counter_value == 4294967295:
-        overflow = True
-      else:
-        send += counter_value * 4
+      continue
 
-  global send_prev, recv_prev, time_prev
-  if overflow:
-    _reset_counters()
+    # Total number of data octets, divided by 4 (lanes), transmitted/received 
+    # on all VLs.
+    recv += deltas.get('port_rcv_data', 0) * 4
+    send += deltas.get('port_xmit_data', 0) * 4
 
-    # set new previous values
-    recv_prev = 0
-    send_prev = 0
-  else:
-    if recv >= recv_prev and send >= send_prev:
-      ib_bw = ( recv - recv_prev + send - send_prev ) / ( timestamp - time_prev )
+    if perPort and interval > 0 and deltas:
+      _dispatch_port(ibPort, deltas, interval, timestamp)
 
-      # TODO: change to derive type?
-      vl = collectd.Values(type='gauge')
-      vl.plugin='infiniband'
-      vl.values = [ib_bw]
-      vl.time = timestamp
-      vl.type_instance = 'bw'
-      vl.dispatch()
+  if interval > 0:
+    ib_bw = ( recv + send ) / ( timestamp - time_prev )
 
-    # set new previous values
-    recv_prev = recv
-    send_prev = send
+    vl = collectd.Values(type='gauge')
+    vl.plugin='infiniband'
+    vl.values = [ib_bw]
+    vl.time = timestamp
+    vl.type_instance = 'bw'
+    vl.dispatch()
 
   time_prev = timestamp
 
+  if samplerThread:
+    _dispatch_sample_summaries(timestamp)
+
   # check the IB files again, if an error occurred
   if value_error:
     _setupSourcefiles()
@@ -288,7 +610,8 @@ def ib_plugin_notify(notification, data=None):
     global enabled
     if notification.message == "check":
       collectd.info("ib_bw plugin: Check IB files ...")
-      _setupSourcefiles()
+      with portLock:
+        _setupSourcefiles()
       global num_reads
       num_reads = 0
     elif notification.message == "disable":
@@ -316,6 +639,7 @@ if __name__ != "__main__":
   collectd.register_config(ib_plugin_config)
   collectd.register_init(ib_plugin_initialize)
   collectd.register_notification(ib_plugin_notify)
+  collectd.register_shutdown(ib_plugin_shutdown)
 
   # always register read plugin, which triggers the file checks once a while
   collectd.register_read(ib_plugin_read)
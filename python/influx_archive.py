@@ -0,0 +1,427 @@
+# coding=utf-8
+
+"""
+Compact local archive files for metrics of the InfluxDB write plugin.
+
+Archive files are written by influx_write (option 'output') and imported into
+InfluxDB with influx_import.py. There is one file per target (database and
+retention policy) and time window. Files of the current window have the suffix
+'.part' and are renamed, when the window is complete.
+
+File layout (all integers little-endian):
+  header: MAGIC, uint32 length, JSON meta data (database, retention_policy,
+          precision, window_start, window, host)
+  blocks: BLOCK_MAGIC (zlib) or BLOCK_MAGIC_LZ4 (lz4), uint32 compressed length, 
+          uint32 number of rows, compressed payload
+
+Each block stores the rows of one batch with a fixed schema in columns:
+  uint32 string table length, string table ('\\n' separated),
+  time (int64), measurement (uint32), tags (uint32), field (uint32), value (float64),
+  value type (uint8, 1: integer), integer value (int64)
+Measurement, tags and field are indices into the string table. Tags are stored
+as escaped line protocol tag set (e.g. 'cpu=0,hostname=node1'). Integer values
+are written as integers ('5i') to keep the field type of the live writes. 
+Blocks without the type columns (older files) contain only float values.
+"""
+
+import os
+import sys
+import json
+import zlib
+import struct
+import time
+import socket
+from array import array
+
+try:
+  import lz4.frame as lz4frame
+except ImportError:
+  lz4frame = None
+
+MAGIC = b'PKAR\x01'
+BLOCK_MAGIC = b'PKBL'
+BLOCK_MAGIC_LZ4 = b'PKB4'
+FILE_SUFFIX = '.pka'
+PART_SUFFIX = '.part'
+
+_HEADER_LEN = struct.Struct('<I')
+_BLOCK_HEADER = struct.Struct('<4sII')
+
+# array type codes for the columns (time, measurement, tags, field, value)
+_COLUMN_TYPES = ('q', 'I', 'I', 'I', 'd')
+
+# array type codes for the value type and the integer value columns
+_TYPE_COLUMN_TYPES = ('B', 'q')
+_INT_MIN = -2**63
+_INT_MAX = 2**63 - 1
+
+# time units per second of the InfluxDB time precisions
+_PRECISION_FACTORS = {'n': 10**9, 'u': 10**6, 'ms': 10**3, 's': 1, 'm': 1.0 / 60, 'h': 1.0 / 3600}
+
+"""
+Escape a tag key or value for the line protocol.
+"""
+def escape_tag(value):
+  return str(value).replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('=', '\\=')
+
+"""
+Escape a measurement name for the line protocol.
+"""
+def escape_measurement(value):
+  return str(value).replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,')
+
+"""
+Return the escaped line protocol tag set of a tags dictionary (sorted by key).
+A string is an escaped tag set already (see points).
+"""
+def tag_string(tags):
+  if isinstance(tags, str):
+    return tags
+  return ','.join(escape_tag(k) + '=' + escape_tag(v) for k, v in sorted(tags.items()) if v is not None and v != '')
+
+def _to_bytes(column):
+  if sys.byteorder == 'big':
+    column = array(column.typecode, column)
+    column.byteswap()
+  return column.tobytes()
+
+def _from_bytes(typecode, data):
+  column = array(typecode)
+  column.frombytes(data)
+  if sys.byteorder == 'big':
+    column.byteswap()
+  return column
+
+"""
+Encode the fields of the given points into a compressed block. 
+Codec is 'zlib' or 'lz4' (requires the lz4 module).
+"""
+def encode_block(points, level=6, codec='zlib'):
+  strings = {}
+  columns = [array(t) for t in _COLUMN_TYPES + _TYPE_COLUMN_TYPES]
+  times, measurements, tagsets, fields, values, types, ints = columns
+
+  for point in points:
+    m_idx = strings.setdefault(point['measurement'], len(strings))
+    t_idx = strings.setdefault(tag_string(point['tags']), len(strings))
+    ptime = int(point['time'])
+    for field, value in point['fields'].items():
+      times.append(ptime)
+      measurements.append(m_idx)
+      tagsets.append(t_idx)
+      fields.append(strings.setdefault(field, len(strings)))
+      values.append(float(value))
+      if isinstance(value, int) and not isinstance(value, bool) and _INT_MIN <= value <= _INT_MAX:
+        types.append(1)
+        ints.append(value)
+      else:
+        types.append(0)
+        ints.append(0)
+
+  string_table = '\n'.join(strings).encode('utf-8')
+  payload = b''.join([_HEADER_LEN.pack(len(string_table)), string_table] + [_to_bytes(c) for c in columns])
+  if codec == 'lz4':
+    data = lz4frame.compress(payload)
+    magic = BLOCK_MAGIC_LZ4
+  else:
+    data = zlib.compress(payload, level)
+    magic = BLOCK_MAGIC
+
+  return _BLOCK_HEADER.pack(magic, len(data), len(times)) + data
+
+"""
+Decode a compressed block.
+Return the string table and the columns (time, measurement, tags, field, value
+and, if available, value type and integer value). A truncated payload raises 
+a ValueError.
+"""
+def decode_block(data, num_rows, magic=BLOCK_MAGIC):
+  if magic == BLOCK_MAGIC_LZ4:
+    payload = lz4frame.decompress(data)
+  else:
+    payload = zlib.decompress(data)
+  if len(payload) < _HEADER_LEN.size:
+    raise ValueError("truncated block payload")
+  (length,) = _HEADER_LEN.unpack_from(payload)
+  pos = _HEADER_LEN.size
+  strings = payload[pos:pos+length].decode('utf-8').split('\n')
+  pos += length
+
+  columns = []
+  typecodes = _COLUMN_TYPES
+  if len(payload) > pos + sum(array(t).itemsize for t in _COLUMN_TYPES) * num_rows:
+    typecodes += _TYPE_COLUMN_TYPES
+  for typecode in typecodes:
+    size = array(typecode).itemsize * num_rows
+    columns.append(_from_bytes(typecode, payload[pos:pos+size]))
+    pos += size
+
+  return strings, columns
+
+"""
+Decode a block including its header (as returned by encode_block).
+"""
+def decode(block):
+  if len(block) < _BLOCK_HEADER.size:
+    raise ValueError("truncated block header")
+  magic, length, num_rows = _BLOCK_HEADER.unpack_from(block)
+  return decode_block(block[_BLOCK_HEADER.size:_BLOCK_HEADER.size+length], num_rows, magic)
+
+"""
+Convert decoded blocks into line protocol lines. Rows of the same point 
+(measurement, tags and time) are written as one line.
+"""
+def lines(blocks):
+  for strings, columns in blocks:
+    measurements = [escape_measurement(s) for s in strings]
+    fields = [escape_tag(s) for s in strings]
+    times, m_idxs, t_idxs, f_idxs, values = columns[:5]
+    types, ints = columns[5:] if len(columns) > 5 else (None, None)
+
+    prev = None
+    line = None
+    for row in range(len(times)):
+      key = (m_idxs[row], t_idxs[row], times[row])
+      if types and types[row]:
+        field = fields[f_idxs[row]] + '=' + str(ints[row]) + 'i'
+      else:
+        field = fields[f_idxs[row]] + '=' + repr(values[row])
+      if key == prev:
+        line.append(field)
+        continue
+
+      if line is not None:
+        yield line[0] + ' ' + ','.join(line[1:]) + ' ' + str(prev[2])
+
+      series = measurements[key[0]]
+      if strings[key[1]]:
+        series += ',' + strings[key[1]]
+      line = [series, field]
+      prev = key
+
+    if line is not None:
+      yield line[0] + ' ' + ','.join(line[1:]) + ' ' + str(prev[2])
+
+"""
+Convert decoded blocks into points (dictionaries as passed to encode_block), 
+e.g. to write the backlog of influx_write to an archive file. Rows of the same 
+point are merged, the tags are the escaped tag set string.
+"""
+def points(blocks):
+  for strings, columns in blocks:
+    times, m_idxs, t_idxs, f_idxs, values = columns[:5]
+    types, ints = columns[5:] if len(columns) > 5 else (None, None)
+
+    prev = None
+    point = None
+    for row in range(len(times)):
+      key = (m_idxs[row], t_idxs[row], times[row])
+      if key != prev:
+        if point is not None:
+          yield point
+        point = {'measurement': strings[key[0]], 'tags': strings[key[1]], 
+                 'time': times[row], 'fields': {}}
+        prev = key
+
+      value = ints[row] if types and types[row] else values[row]
+      point['fields'][strings[f_idxs[row]]] = value
+
+    if point is not None:
+      yield point
+
+# errors of corrupted compressed data (lz4.frame raises RuntimeError)
+_DECODE_ERRORS = (zlib.error, RuntimeError, struct.error)
+
+"""
+Read an archive file. Return the meta data and a generator over its blocks
+(string table and columns). An incomplete last block (e.g. from a crash) is
+ignored, a corrupted block or file header raises a ValueError.
+"""
+def read_archive(path):
+  f = open(path, 'rb')
+  if f.read(len(MAGIC)) != MAGIC:
+    f.close()
+    raise ValueError("%s is not an archive file" % (path,))
+
+  header = f.read(_HEADER_LEN.size)
+  if len(header) < _HEADER_LEN.size:
+    f.close()
+    raise ValueError("truncated header in %s" % (path,))
+  (length,) = _HEADER_LEN.unpack(header)
+  try:
+    meta = json.loads(f.read(length).decode('utf-8'))
+  except ValueError as ex:
+    f.close()
+    raise ValueError("corrupted header in %s (%s)" % (path, ex))
+
+  def blocks():
+    try:
+      while True:
+        header = f.read(_BLOCK_HEADER.size)
+        if len(header) < _BLOCK_HEADER.size:
+          return
+        magic, length, num_rows = _BLOCK_HEADER.unpack(header)
+        data = f.read(length)
+        if magic not in (BLOCK_MAGIC, BLOCK_MAGIC_LZ4) or len(data) < length:
+          return
+        try:
+          block = decode_block(data, num_rows, magic)
+        except _DECODE_ERRORS as ex:
+          raise ValueError("corrupted block in %s (%s)" % (path, ex))
+        yield block
+    finally:
+      f.close()
+
+  return meta, blocks()
+
+"""
+Truncate an archive file after its last complete block (e.g. after a crash 
+while writing). Return False, if not even the header is complete.
+"""
+def repair_archive(path):
+  with open(path, 'r+b') as f:
+    size = os.fstat(f.fileno()).st_size
+    header = f.read(len(MAGIC) + _HEADER_LEN.size)
+    if len(header) < len(MAGIC) + _HEADER_LEN.size or header[:len(MAGIC)] != MAGIC:
+      return False
+    (length,) = _HEADER_LEN.unpack_from(header, len(MAGIC))
+    end = len(header) + length
+    if end > size:
+      return False
+
+    while end + _BLOCK_HEADER.size <= size:
+      f.seek(end)
+      magic, length, num_rows = _BLOCK_HEADER.unpack(f.read(_BLOCK_HEADER.size))
+      if magic not in (BLOCK_MAGIC, BLOCK_MAGIC_LZ4) or end + _BLOCK_HEADER.size + length > size:
+        break
+      end += _BLOCK_HEADER.size + length
+
+    if end < size:
+      f.truncate(end)
+
+  return True
+
+"""
+Writes batches of points to rotating archive files, one file per target
+(database, retention policy) and time window.
+"""
+class ArchiveWriter(object):
+  def __init__(self, directory, window=3600, precision='s', level=6):
+    self.directory = directory
+    self.window = int(window)
+    self.precision = precision
+    self.level = level
+    self.host = socket.gethostname()
+    self.files = {} # target -> (window start, file object, path)
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    self._finalizeLeftovers()
+
+  """
+  Complete the '.part' files left by a previous run (e.g. after a crash), 
+  which would otherwise never be renamed. An incomplete last block is cut off.
+  """
+  def _finalizeLeftovers(self):
+    for entry in os.scandir(self.directory):
+      if not entry.name.endswith(FILE_SUFFIX + PART_SUFFIX):
+        continue
+
+      if not repair_archive(entry.path):
+        os.remove(entry.path)
+        continue
+
+      final_path = entry.path[:-len(PART_SUFFIX)]
+      base = final_path[:-len(FILE_SUFFIX)]
+      suffix = 0
+      while os.path.exists(final_path):
+        suffix += 1
+        final_path = '%s-%d%s' % (base, suffix, FILE_SUFFIX)
+      os.rename(entry.path, final_path)
+
+  def _path(self, target, window_start):
+    database, rp = target
+    name = str(database)
+    if rp:
+      name += '.' + rp
+    return os.path.join(self.directory, '%s_%s_%d' % (name, self.host, window_start))
+
+  def _open(self, target, window_start):
+    path = self._path(target, window_start)
+
+    # do not append to a completed (maybe already imported) file of this window
+    suffix = 0
+    final_path = path + FILE_SUFFIX
+    while os.path.exists(final_path):
+      suffix += 1
+      final_path = '%s-%d%s' % (path, suffix, FILE_SUFFIX)
+
+    part_path = final_path + PART_SUFFIX
+    # do not append after an incomplete block
+    exists = os.path.exists(part_path) and repair_archive(part_path)
+    f = open(part_path, 'ab' if exists else 'wb')
+    if not exists:
+      meta = json.dumps({'database': target[0], 'retention_policy': target[1],
+                         'precision': self.precision, 'window_start': window_start,
+                         'window': self.window, 'host': self.host}).encode('utf-8')
+      f.write(MAGIC + _HEADER_LEN.pack(len(meta)) + meta)
+
+    return f, part_path
+
+  def _finalize(self, target):
+    window_start, f, part_path = self.files.pop(target)
+    f.close()
+    os.rename(part_path, part_path[:-len(PART_SUFFIX)])
+
+  """
+  Complete the files of windows, which have ended (wall clock), also for 
+  targets without new points.
+  """
+  def finalize_ended(self):
+    now = time.time() * _PRECISION_FACTORS.get(self.precision, 1)
+    for target in [t for t, current in self.files.items() if current[0] + self.window <= now]:
+      self._finalize(target)
+
+  """
+  Append the points to the archive file of the target. Points are split by
+  their time window. A file is completed, when points of a newer window arrive
+  or its window has ended (see finalize_ended).
+  """
+  def write(self, target, points):
+    self.finalize_ended()
+
+    windows = {}
+    for point in points:
+      window_start = int(point['time']) // self.window * self.window
+      windows.setdefault(window_start, []).append(point)
+
+    for window_start in sorted(windows):
+      current = self.files.get(target)
+      if current is not None and current[0] < window_start:
+        self._finalize(target)
+        current = None
+
+      block = encode_block(windows[window_start], self.level)
+      if current is not None and current[0] == window_start:
+        f = current[1]
+        f.write(block)
+        f.flush()
+      elif current is None:
+        f, part_path = self._open(target, window_start)
+        f.write(block)
+        f.flush()
+        self.files[target] = (window_start, f, part_path)
+      else:
+        # late points of an older window go to a separate, completed file
+        f, part_path = self._open(target, window_start)
+        f.write(block)
+        f.close()
+        os.rename(part_path, part_path[:-len(PART_SUFFIX)])
+
+  """
+  Complete all open archive files.
+  """
+  def close(self):
+    for target in list(self.files):
+      self._finalize(target)
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# coding=utf-8
+
+"""
+Bulk import of archive files (written by influx_write with output "archive" or
+"both") into InfluxDB.
+
+Blocks of the archive files are streamed into line protocol batches, which are
+written with several parallel connections. Incomplete files (suffix '.part')
+are skipped, unless they are given explicitly.
+
+Example:
+  influx_import.py --host db01 --workers 8 --delete /var/spool/pika/archive
+"""
+
+import os
+import sys
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import influx_archive
+
+try:
+  from influxdb.client import InfluxDBClient
+except ImportError:
+  InfluxDBClient = None
+
+"""
+Return the archive files given directly or found in the given directories.
+"""
+def _files(paths):
+  files = []
+  for path in paths:
+    if os.path.isdir(path):
+      for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.is_file() and entry.name.endswith(influx_archive.FILE_SUFFIX):
+          files.append(entry.path)
+    else:
+      files.append(path)
+  return files
+
+def main():
+  parser = argparse.ArgumentParser(description='Import archive files into InfluxDB.')
+  parser.add_argument('paths', nargs='+', help='archive files or directories')
+  parser.add_argument('--host', default='localhost')
+  parser.add_argument('--port', type=int, default=8086)
+  parser.add_argument('--user', default=None)
+  parser.add_argument('--pwd', default=None)
+  parser.add_argument('--ssl', action='store_true')
+  parser.add_argument('--database', default=None, help='overwrite the database of the archive files')
+  parser.add_argument('--batch-size', type=int, default=50000, help='lines per write request')
+  parser.add_argument('--workers', type=int, default=4, help='number of parallel write requests')
+  parser.add_argument('--delete', action='store_true', help='delete files after a successful import')
+  args = parser.parse_args()
+
+  if not InfluxDBClient:
+    print("influxdb.client.InfluxDBClient import failed.", file=sys.stderr)
+    return 1
+
+  local = threading.local()
+  def write(lines, database, rp, precision):
+    if not hasattr(local, 'client'):
+      local.client = InfluxDBClient(host=args.host, port=args.port, username=args.user,
+                                    password=args.pwd, ssl=args.ssl)
+    local.client.write_points(lines, time_precision=precision, database=database,
+                              retention_policy=rp, protocol='line')
+    return len(lines)
+
+  failed = 0
+  total = 0
+  with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    for path in _files(args.paths):
+      try:
+        meta, blocks = influx_archive.read_archive(path)
+      except (IOError, ValueError) as ex:
+        print("Skip %s (%s)" % (path, ex), file=sys.stderr)
+        failed += 1
+        continue
+
+      database = args.database or meta['database']
+      rp = meta.get('retention_policy')
+      precision = meta.get('precision', 's')
+
+      # stream batches with a bounded number of pending requests
+      pending = set()
+      errors = 0
+      lines = []
+      def submit(lines):
+        nonlocal errors, total
+        pending.add(executor.submit(write, lines, database, rp, precision))
+        if len(pending) >= 2 * args.workers:
+          done, _ = wait(pending, return_when=FIRST_COMPLETED)
+          for future in done:
+            pending.discard(future)
+            if future.exception():
+              print("Write error for %s: %s" % (path, future.exception()), file=sys.stderr)
+              errors += 1
+            else:
+              total += future.result()
+
+      try:
+        for line in influx_archive.lines(blocks):
+          lines.append(line)
+          if len(lines) >= args.batch_size:
+            submit(lines)
+            lines = []
+        if lines:
+          submit(lines)
+      except (IOError, ValueError) as ex:
+        print("Skip %s (%s)" % (path, ex), file=sys.stderr)
+        errors += 1
+
+      for future in wait(pending)[0]:
+        if future.exception():
+          print("Write error for %s: %s" % (path, future.exception()), file=sys.stderr)
+          errors += 1
+        else:
+          total += future.result()
+
+      if errors:
+        failed += 1
+      else:
+        print("Imported %s" % (path,))
+        if args.delete:
+          os.remove(path)
+
+  print("%d lines imported, %d files failed" % (total, failed))
+  return 1 if failed else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,276 @@
+# coding=utf-8
+
+"""
+Node-local ring buffer with the most recent metrics of the InfluxDB write
+plugin and a Unix socket to query them (option 'ring_minutes' and
+'ring_socket' of influx_write).
+
+Each series (measurement, tag set, field) has a fixed-size ring of time stamps
+and values. Requests are single lines, answers are lines terminated by an
+empty line. Invalid requests are answered with a line starting with 'ERROR'.
+
+  LIST [measurement]
+    series as 'measurement,tags field'
+  RANGE <measurement> <field> <start> [<end>] [tag=value ...]
+    points in line protocol
+  AGG <min|max|mean|sum|count|last> <measurement> <field> <start> [<end>] [tag=value ...]
+    one line per series 'measurement,tags field_<func>=value'
+
+Measurement and field may be '*' (all). Start and end are epoch seconds or,
+if negative, seconds relative to now (e.g. -300). A tag filter 'jobid=ID'
+also matches series with several job IDs.
+
+Example:
+  echo "AGG mean cpu used -300 jobid=1234" | socat - UNIX-CLIENT:/run/collectd/influx_ring.sock
+"""
+
+import os
+import time
+import socket
+import threading
+from array import array
+
+from influx_archive import escape_tag, escape_measurement, tag_string
+
+AGGREGATES = ('min', 'max', 'mean', 'sum', 'count', 'last')
+
+"""
+Fixed-size ring of time stamps and values.
+"""
+class RingBuffer(object):
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.times = array('q', [0] * capacity)
+    self.values = array('d', [0.0] * capacity)
+    self.pos = 0 # next write position
+    self.count = 0
+
+  def append(self, timestamp, value):
+    self.times[self.pos] = timestamp
+    self.values[self.pos] = value
+    self.pos = (self.pos + 1) % self.capacity
+    if self.count < self.capacity:
+      self.count += 1
+
+  """
+  Return the (time, value) pairs within [start, end] in the order of insertion.
+  """
+  def range(self, start, end):
+    first = (self.pos - self.count) % self.capacity
+    result = []
+    for i in range(self.count):
+      idx = (first + i) % self.capacity
+      t = self.times[idx]
+      if start <= t <= end:
+        result.append((t, self.values[idx]))
+    return result
+
+"""
+Ring buffers of all series. Series that have not been updated for the ring
+duration are removed.
+"""
+class SeriesStore(object):
+  def __init__(self, seconds, interval=10):
+    self.seconds = int(seconds)
+    self.capacity = max(2, self.seconds // max(1, int(interval)) + 1)
+    self.lock = threading.Lock()
+    self.series = {} # (measurement, tag string, field) -> (tags, RingBuffer)
+    self.next_cleanup = 0
+
+  """
+  Add prepared points (dictionaries with measurement, tags, time and fields).
+  """
+  def add(self, points):
+    with self.lock:
+      for point in points:
+        tags = point['tags']
+        tagset = tag_string(tags)
+        ptime = int(point['time'])
+        for field, value in point['fields'].items():
+          key = (point['measurement'], tagset, field)
+          entry = self.series.get(key)
+          if entry is None:
+            entry = (dict(tags), RingBuffer(self.capacity))
+            self.series[key] = entry
+          entry[1].append(ptime, float(value))
+
+      now = time.time()
+      if now >= self.next_cleanup:
+        self._cleanup(now)
+        self.next_cleanup = now + self.seconds
+
+  def _cleanup(self, now):
+    for key in [key for key, (tags, ring) in self.series.items()
+                if ring.count == 0 or ring.times[(ring.pos - 1) % ring.capacity] < now - self.seconds]:
+      del self.series[key]
+
+  """
+  Return the series (key, tags, ring) matching measurement, field and tag filter.
+  Requires the lock.
+  """
+  def _select(self, measurement, field, tag_filter):
+    selected = []
+    for key, (tags, ring) in self.series.items():
+      if measurement != '*' and key[0] != measurement:
+        continue
+      if field != '*' and key[2] != field:
+        continue
+      matched = True
+      for tag, value in tag_filter.items():
+        actual = tags.get(tag)
+        if actual is None or (actual != value and value not in str(actual).split(',')):
+          matched = False
+          break
+      if matched:
+        selected.append((key, tags, ring))
+    return sorted(selected, key=lambda s: s[0])
+
+  def list(self, measurement='*'):
+    with self.lock:
+      return ['%s %s' % (_series(key), escape_tag(key[2])) for key, tags, ring in self._select(measurement, '*', {})]
+
+  def range(self, measurement, field, start, end, tag_filter):
+    lines = []
+    with self.lock:
+      for key, tags, ring in self._select(measurement, field, tag_filter):
+        for t, value in ring.range(start, end):
+          lines.append('%s %s=%r %d' % (_series(key), escape_tag(key[2]), value, t))
+    return lines
+
+  def aggregate(self, func, measurement, field, start, end, tag_filter):
+    lines = []
+    with self.lock:
+      for key, tags, ring in self._select(measurement, field, tag_filter):
+        values = [value for t, value in ring.range(start, end)]
+        if not values:
+          continue
+        if func == 'min':
+          result = min(values)
+        elif func == 'max':
+          result = max(values)
+        elif func == 'mean':
+          result = sum(values) / len(values)
+        elif func == 'sum':
+          result = sum(values)
+        elif func == 'count':
+          result = len(values)
+        else:
+          result = values[-1]
+        lines.append('%s %s_%s=%r' % (_series(key), escape_tag(key[2]), func, result))
+    return lines
+
+def _series(key):
+  series = escape_measurement(key[0])
+  if key[1]:
+    series += ',' + key[1]
+  return series
+
+def _parseTime(value, now):
+  t = int(float(value))
+  return now + t if t <= 0 else t
+
+"""
+Parse the optional end time and the tag filters of a RANGE or AGG request.
+"""
+def _parseRange(args, now):
+  start = _parseTime(args[0], now)
+  end = now
+  filters = {}
+  for arg in args[1:]:
+    if '=' in arg:
+      tag, value = arg.split('=', 1)
+      filters[tag] = value
+    else:
+      end = _parseTime(arg, now)
+  return start, end, filters
+
+"""
+Answer a single request line. Return the answer lines.
+"""
+def handle_request(store, request):
+  args = request.split()
+  if not args:
+    raise ValueError("empty request")
+
+  command = args[0].upper()
+  now = int(time.time())
+  if command == 'LIST':
+    return store.list(args[1] if len(args) > 1 else '*')
+  elif command == 'RANGE' and len(args) >= 4:
+    start, end, filters = _parseRange(args[3:], now)
+    return store.range(args[1], args[2], start, end, filters)
+  elif command == 'AGG' and len(args) >= 5:
+    if args[1] not in AGGREGATES:
+      raise ValueError("unknown aggregate %s" % (args[1],))
+    start, end, filters = _parseRange(args[4:], now)
+    return store.aggregate(args[1], args[2], args[3], start, end, filters)
+
+  raise ValueError("invalid request '%s'" % (request,))
+
+"""
+Unix socket server answering queries on a SeriesStore in a daemon thread. Each
+connection is handled in its own thread, so a slow client does not block the 
+others. The socket file gets the given permissions (independent of the umask).
+"""
+class QueryServer(object):
+  def __init__(self, store, path, log=None, mode=0o660):
+    self.store = store
+    self.path = path
+    self.log = log
+    self.running = False
+
+    if os.path.exists(path):
+      os.remove(path)
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.bind(path)
+    os.chmod(path, mode)
+    self.sock.listen(16)
+    self.thread = threading.Thread(target=self._serve, name='influx_ring')
+    self.thread.daemon = True
+
+  def start(self):
+    self.running = True
+    self.thread.start()
+
+  def _serve(self):
+    while self.running:
+      try:
+        conn, addr = self.sock.accept()
+      except (OSError, socket.error):
+        break
+
+      handler = threading.Thread(target=self._handle, args=(conn,), name='influx_ring query')
+      handler.daemon = True
+      handler.start()
+
+  def _handle(self, conn):
+    try:
+      conn.settimeout(5)
+      f = conn.makefile('rwb')
+      for request in f:
+        request = request.decode('utf-8').strip()
+        if not request:
+          break
+        try:
+          answer = handle_request(self.store, request)
+        except ValueError as ex:
+          answer = ['ERROR %s' % (ex,)]
+        f.write(('\n'.join(answer + ['']) + '\n').encode('utf-8'))
+        f.flush()
+      f.close()
+    except (OSError, socket.error) as ex:
+      if self.log:
+        self.log("query connection failed (%s)" % (ex,))
+    finally:
+      conn.close()
+
+  def stop(self):
+    self.running = False
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, socket.error):
+      pass
+    self.sock.close()
+    self.thread.join(5)
+    if os.path.exists(self.path):
+      os.remove(self.path)
@@ -14,20 +14,34 @@ tag value (metric specific) <- plugin instance
 Additionally, the host name is written as tag for 'hostname'.
 
 A collectd value is identified by plugin, plugin instance, type and type instance.
+
+If job ID tagging is enabled, the ID of the job running on the node (only if 
+exactly one job runs) or on the CPU (for per-CPU plugins) is written as tag 
+'jobid'.
 """
 
 import collectd
+import influx_archive
+import influx_ring
 import os
 import math
 import subprocess
 import re
+import time
+import random
+import collections
+import threading
+import glob
+from fnmatch import fnmatchcase
+from email.utils import parsedate_to_datetime
 
 try:
   from influxdb.client import InfluxDBClient
 except ImportError:
   InfluxDBClient = None
 
-influx = None
+# per thread connection (InfluxDB client) and last HTTP response
+local = threading.local()
 
 ssl = False
 hostname = 'localhost'
@@ -37,13 +51,48 @@ password = None
 database = None # name of the database
 
 conf_batch_size = 200   # number of metrics to be sent in one batch
-conf_cache_size = 2000  # maximum number of metrics to store locally (e.g. if sends fail)
-batch_count = 0
-batch = {} # all unsent value lists are stored here
-batch_size = conf_batch_size
+conf_cache_size = 2000  # maximum number of value lists to store until they are sent
+
+# all unsent value lists are stored in shards (see _Shard), which are selected
+# by series, one batch per latency class and target (see _Batch) in each shard
+conf_shards = 1
+shards = []
 
 store_rates = False
-batch_derive = {} # storage for previous value lists of derived/counter types
+
+#### Compressed backlog of points that could not be sent ####
+conf_backlog_size = 16 * 1024 * 1024 # maximum bytes of compressed backlog chunks
+conf_backlog_window = 60 # seconds of data per backlog chunk
+conf_backlog_compression = 'zlib' # 'zlib' or 'lz4'
+backlogs = {} # (destination ('influx' or 'archive'), target) -> _Backlog
+backlog_bytes = 0 # bytes of all sealed backlog chunks
+backlog_lock = threading.Lock() # protects backlogs and backlog_bytes
+########################################
+
+#### Routing of plugins to databases and retention policies ####
+# list of (compiled plugin pattern, database, retention policy), first match wins
+routes = []
+
+# cache of plugin name -> target (database, retention policy)
+target_cache = {}
+########################################
+
+#### Latency classes ####
+# list of (class name, maximum delay in seconds, [compiled plugin patterns]),
+# first match wins, plugins without a matching class are in class 'default'
+latency_classes = []
+
+# maximum delay of values in the default class (None: send full batches only)
+default_max_delay = None
+
+# cache of plugin name -> (class name, maximum delay)
+class_cache = {}
+
+# sends batches of latency classes, when their deadline is reached
+sender_thread = None
+sender_running = False
+sender_condition = threading.Condition()
+########################################
 
 #### Mapping of HW threads to cores ####
 per_core_plugins = None
@@ -55,24 +104,207 @@ threads_per_core = 1
 # hardware thread ID is provided by the OS contiguous, starting from zero
 coreMapping = None
 
-# timestamp of the current group of values (see write() and _collect()) with seconds precision
-currentTimestamp = 0
-
 #num_aggregated = 0
 ########################################
 
 time_precision = 's'
 
+#### Job ID tagging ####
+jobid_tag = False
+
+# glob patterns of job directories (Slurm cgroups or spool directories), the 
+# directory name contains the job ID, cpuset files assign CPUs to the job
+DEFAULT_JOB_PATHS = [
+  '/sys/fs/cgroup/cpuset/slurm*/uid_*/job_*',
+  '/sys/fs/cgroup/system.slice/slurmstepd.scope/job_*'
+]
+job_paths = None
+jobIdPattern = re.compile(r'job_?0*(\d+)')
+
+# (HW thread ID -> job ID, list of the job IDs of the node)
+job_map = ({}, [])
+
+# modification times of the directories, which contain the job directories
+job_dir_mtimes = None
+
+# job directories are checked for changes at most every job_check_interval seconds
+job_check_interval = 30
+jobs_next_check = 0
+jobs_lock = threading.Lock()
+jobs_dirty = False # a forced check was requested during a running check
+########################################
+
+#### Local archive output (see influx_archive.py and influx_import.py) ####
+# where metrics are written to: 'influx', 'archive' or 'both'
+output = 'influx'
+archive_directory = None
+archive_window = 3600 # seconds of data per archive file
+archive_writer = None
+archive_lock = threading.Lock()
+
+#### CPU overhead budget ####
+# maximum share of one CPU used by this plugin, e.g. 0.005 for 0.5% (0: disabled)
+conf_cpu_budget = 0
+conf_budget_interval = 60 # seconds, after which the CPU usage is checked
+
+# modes, which are enabled one after the other, while the budget is exceeded
+BUDGET_LEVELS = ('normal', 'large batches', 'drop low-priority plugins', 'rollups only')
+LARGE_BATCH_FACTOR = 4 # batch and cache size factor from level 'large batches'
+budget_level = 0
+
+# compiled patterns of plugins, which are dropped from level 'drop low-priority plugins'
+low_priority = []
+priority_cache = {} # plugin name -> True, if low priority
+
+# from level 'rollups only', only one value list per series and rollup interval 
+# is collected (mean of gauges, last value of counters)
+conf_rollup_interval = 60
+
+# thread CPU time (seconds) used since budget_start (monotonic time)
+budget_used = 0.0
+budget_start = 0
+budget_lock = threading.Lock()
+########################################
+
+#### Node-local ring buffer of recent metrics (see influx_ring.py) ####
+ring_minutes = 0 # minutes of recent metrics per series (0: disabled)
+ring_interval = 10 # expected seconds between values of a series (ring size)
+ring_socket = None # path of the Unix socket to query the ring buffer
+ring_socket_perms = 0o660 # permissions of the socket file
+ring_store = None
+ring_server = None
+
+#### Rate limiting ####
+# maximum number of points and bytes per second sent to InfluxDB (0: unlimited)
+conf_max_points_rate = 0
+conf_max_bytes_rate = 0
+
+# response time (seconds) above which the send rates are lowered (0: disabled)
+conf_latency_target = 0
+
+# token buckets for points and bytes (created in init_callback)
+points_bucket = None
+bytes_bucket = None
+
+# no data is sent before this (monotonic) time, e.g. after a 429/503 response
+backoff_until = 0
+backoff_count = 0 # number of consecutive overload responses
+
+# protects token buckets and backoff, as several threads send
+rate_lock = threading.Lock()
+
+# (status code, Retry-After header, response time, request size) of the last
+# HTTP response of a thread is stored in local.last_response (see _response_hook)
+# and the status code of its last failed write in local.write_error
+
+# HTTP status codes with which an overloaded InfluxDB server answers
+OVERLOAD_STATUS_CODES = (429, 503)
+# HTTP status codes for bad data (e.g. field type conflict), which will never succeed
+REJECTED_STATUS_CODES = (400,)
+MAX_BACKOFF = 300 # maximum backoff in seconds without a Retry-After header
+MIN_RATE_FACTOR = 0.05 # rates are not lowered below this share of the configured rate
+########################################
+
+"""
+Token bucket with an automatically adapted refill rate. 
+
+The bucket may go into debt: a batch is sent, if any tokens are available, and
+its actual size is consumed afterwards. Batches larger than the bucket are 
+therefore not blocked forever, but delay the next send accordingly.
+"""
+class _TokenBucket(object):
+  def __init__(self, rate):
+    self.max_rate = float(rate) # configured rate
+    self.rate = float(rate)     # current (adapted) rate
+    self.tokens = float(rate)   # bucket capacity is one second of the rate
+    self.last = time.monotonic()
+
+  def _refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+  def available(self):
+    self._refill()
+    return self.tokens > 0
+
+  def consume(self, amount):
+    self._refill()
+    self.tokens -= amount
+
+  # multiplicative decrease (server is overloaded or slow)
+  def decrease(self):
+    self.rate = max(self.max_rate * MIN_RATE_FACTOR, self.rate * 0.5)
+
+  # additive increase (server responds fast)
+  def increase(self):
+    self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+
+
+"""
+Unsent value lists for one latency class and target (database, retention policy). 
+
+Value lists are stored per plugin and plugin instance (tag): 
+{plugin: {tag: [value lists]}}
+
+Batches of latency classes have a deadline (time of the first value plus the 
+maximum delay of the class), at which the sender thread sends them.
+"""
+class _Batch(object):
+  def __init__(self, target, latency_class='default', max_delay=None):
+    self.target = target         # (database, retention policy)
+    self.latency_class = latency_class
+    self.max_delay = max_delay   # maximum seconds a value waits in the batch
+    self.deadline = None         # monotonic time, at which the batch is sent
+    self.values = {}             # all unsent value lists of this target
+    self.count = 0               # number of unsent value lists
+    self.size = conf_batch_size  # send threshold
+    self.derive = {}             # previous value lists of derived/counter types
+
+  def clear(self):
+    self.values = {}
+    self.count = 0
+    self.deadline = None
+
+"""
+A part of the unsent value lists. Series (plugin and plugin instance) are 
+assigned to shards by their hash, so that several collectd write threads can 
+collect values in parallel. All members are protected by the shard's lock.
+"""
+class _Shard(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.batches = {}  # (latency class, target) -> _Batch
+    self.count = 0     # number of unsent value lists in all batches of this shard
+    self.timestamp = 0 # timestamp of the current group of values (seconds)
+    self.rollups = {}  # series -> [window start, count, sums, last value list, per core] (see _rollup)
+
+"""
+Points of one target that could not be sent. Points of the current backlog 
+window are collected in an open chunk, which is sealed (serialized and 
+compressed) when the window ends or before it is sent. Protected by backlog_lock.
+"""
+class _Backlog(object):
+  def __init__(self):
+    self.chunks = collections.deque() # sealed chunks: (window, block, number of points)
+    self.open_chunk = []              # points of the open backlog window
+    self.open_window = None
 
 """
 Connect to the InfluxDB server
 """
 def _connect():
   try:
-      # Open Connection
-      global influx
+      # Open Connection (one per thread)
       influx = InfluxDBClient(host=hostname, port=port, username=username, 
                               password=password, database=database, ssl=ssl)
+      local.influx = influx
+
+      # get status code, headers and response time of the HTTP responses
+      try:
+        influx._session.hooks['response'].append(_response_hook)
+      except (AttributeError, KeyError):
+        collectd.info("InfluxDB write: HTTP responses not available. Rate adaptation disabled.")
       
       collectd.info("InfluxDB write: established connection to %s:%d/%s." % (hostname, port, database) )
   except Exception as ex:
@@ -80,12 +312,116 @@ def _connect():
       collectd.info("InfluxDB write: failed to connect to %s:%s/%s. (%s:%s) - %s" % (hostname, port, database, username, password, ex) )
       _close()
 
+  return getattr(local, 'influx', None)
+
 """
 Close the socket = do nothing for influx which is http stateless
 """
 def _close():
-    global influx
-    influx = None
+    local.influx = None
+
+"""
+Get the InfluxDB client of the current thread (connect, if needed).
+"""
+def _getClient():
+  influx = getattr(local, 'influx', None)
+  if influx is None and InfluxDBClient:
+    collectd.info('InfluxDB write: connection not available. Try reconnect ...')
+    influx = _connect()
+  return influx
+
+"""
+Remember status code, Retry-After header, response time and request size of
+the last HTTP response from the InfluxDB server (requests response hook).
+"""
+def _response_hook(response, *args, **kwargs):
+  body = response.request.body if response.request is not None else None
+  local.last_response = (response.status_code, response.headers.get('Retry-After'),
+                   response.elapsed.total_seconds(), len(body) if body else 0)
+
+"""
+Parse the value of a Retry-After header (seconds or HTTP date).
+Return the number of seconds to wait or None.
+"""
+def _parseRetryAfter(value):
+  if value is None:
+    return None
+
+  try:
+    return max(0, float(value))
+  except ValueError:
+    pass
+
+  try:
+    return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return None
+
+"""
+Check whether data may be sent now (no backoff active and tokens available).
+"""
+def _rateLimitAllows():
+  with rate_lock:
+    if backoff_until > time.monotonic():
+      return False
+
+    if points_bucket and not points_bucket.available():
+      return False
+
+    if bytes_bucket and not bytes_bucket.available():
+      return False
+
+  return True
+
+"""
+Adapt the send rates to the response of the last write request. 
+On overload (429/503), back off for the time given by the Retry-After header 
+or exponentially (with jitter) and halve the rates. On success, increase the 
+rates again, unless the response time is above the latency target.
+The status code is taken from the last HTTP response, if available.
+"""
+def _adaptRate(success, num_points, status=None):
+  retry_after = None
+  latency = 0
+  num_bytes = 0
+  last_response = getattr(local, 'last_response', None)
+  if last_response:
+    status, retry_after, latency, num_bytes = last_response
+
+  with rate_lock:
+    _adaptRateLocked(success, num_points, num_bytes, status, retry_after, latency)
+
+def _adaptRateLocked(success, num_points, num_bytes, status, retry_after, latency):
+  global backoff_until
+  global backoff_count
+
+  if points_bucket:
+    points_bucket.consume(num_points)
+  if bytes_bucket:
+    bytes_bucket.consume(num_bytes)
+
+  if success:
+    backoff_count = 0
+    slow = conf_latency_target > 0 and latency > conf_latency_target
+    for bucket in (points_bucket, bytes_bucket):
+      if bucket:
+        if slow:
+          bucket.decrease()
+        else:
+          bucket.increase()
+  elif status in OVERLOAD_STATUS_CODES:
+    backoff_count += 1
+    wait = _parseRetryAfter(retry_after)
+    if wait is None:
+      wait = min(MAX_BACKOFF, 2 ** backoff_count) * random.uniform(0.5, 1.0)
+
+    backoff_until = time.monotonic() + wait
+
+    for bucket in (points_bucket, bytes_bucket):
+      if bucket:
+        bucket.decrease()
+
+    collectd.warning("InfluxDB write: server overloaded (status %d). Back off for %.1f seconds." % (status, wait))
 
 """
 Mapping of HW threads to CPU cores (via parsing the output of likwid-topology)
@@ -143,39 +479,26 @@ brief: Store values per plugin instance.
 
 Value lists are stored per plugin and plugin instance. The plugin instance is 
 used as a tag. For per-core plugins (see configuration), the plugin instance is 
-assumed to be the processor ID (given by the OS). 
+the core ID (see write()) and values of the same core and time are summed up.
 
+Requires the lock of the shard that contains the batch.
 Return True, if a value has been added to the batch, otherwise False.
 """
-def _collect(valueList):
-  global batch
-
-  if valueList.plugin: 
-    plugin_name = valueList.plugin
-  else:
-    collectd.error('InfluxDB writer: plugin member is required!')
-    return False
+def _collect(valueList, batch, is_per_core):
+  plugin_name = valueList.plugin
 
   tag = valueList.plugin_instance
 
-  # first check for the tag, which is None for many plugins
-  is_per_core = tag and per_core_plugins and valueList.plugin in per_core_plugins
-
-  # map to core
-  if is_per_core:
-    #collectd.info("value: " + str(valueList))
-    tag = coreMapping[int(tag)]
-    valueList.plugin_instance = tag
-
   # create array for plugin and tag, if it is not available yet
-  if plugin_name in batch:
-    if tag in batch[plugin_name]:
+  values = batch.values
+  if plugin_name in values:
+    if tag in values[plugin_name]:
       # aggregate (sum up) per core, if configured
       if is_per_core:
         # iterate reversed as matches are most probable at the end of the list
         # lists should be very short 
         valueListTimeInt = int(valueList.time)
-        for vlStored in reversed(batch[plugin_name][tag]):
+        for vlStored in reversed(values[plugin_name][tag]):
           if vlStored.type == valueList.type and vlStored.type_instance == valueList.type_instance and int(vlStored.time) == valueListTimeInt:
             for idx in range(len(vlStored.values)):
               vlStored.values[idx] += valueList.values[idx]
@@ -184,83 +507,329 @@ def _collect(valueList):
             return False
 
       # append value
-      batch[plugin_name][tag].append(valueList)
+      values[plugin_name][tag].append(valueList)
     else:
       # create array of values for new tag
-      batch[plugin_name][tag] = [valueList]
+      values[plugin_name][tag] = [valueList]
   else:
     # add the plugin and the tag with a new value
-    batch[plugin_name] = {tag:[valueList]}
+    values[plugin_name] = {tag:[valueList]}
+
+  batch.count += 1
+
+  # first value of a latency class batch: wake up sender to schedule its deadline
+  if batch.max_delay is not None and batch.deadline is None:
+    batch.deadline = time.monotonic() + batch.max_delay
+    with sender_condition:
+      sender_condition.notify()
 
   return True
 
 
 """
-Send data to InfluxDB. Data that cannot be sent will be kept in cache.
+Take the selected batches of a shard: prepare their metrics and clear them.
+Requires the shard lock. Return a list of (deadline, target, metrics).
 """
-def _send():
-  global batch
-  global batch_count
-  global batch_derive
-  global batch_size
-  #global num_aggregated
-
-  if not influx:
-    collectd.info('InfluxDB write: connection not available. Try reconnect ...')
-    _connect()
+def _takeBatches(shard, select=None):
+  taken = []
+  for batch in shard.batches.values():
+    if batch.count == 0 or (select and not select(batch)):
+      continue
 
-  metrics = _prepare_metrics()
+    metrics = _prepare_metrics(batch)
 
-  # reset batch which only contains initial values of derived metrics
-  if len(metrics) == 0:
-    batch = {}
-    batch_count = 0
-    if len(batch_derive) == 0:
+    # an empty list means the batch only contains initial values of derived metrics
+    if len(metrics) == 0 and len(batch.derive) == 0:
       collectd.info('InfluxDB write: no metrics to send. '
         'No previous values are stored. Should not happen!')
+
+    # Send data to InfluxDB (len(metrics) <= batch.count as NaN and inf are not moved from batch to metrics)
+    collectd.info('InfluxDB write: %d lines (%d series) to %s%s' 
+                  % (len(metrics), batch.count, batch.target[0], '' if batch.target[1] is None else '.' + batch.target[1]))
+    #collectd.info('InfluxDB write: %d lines (%d series incl. %d rates), %d aggregated' % (len(metrics), batch.count, len(batch.derive), num_aggregated) )
+    #collectd.info(str(metrics))
+
+    taken.append((batch.deadline, batch.target, metrics))
+    shard.count -= batch.count
+    batch.clear()
+    #num_aggregated = 0
+
+  return taken
+
+"""
+Take the value lists of a shard that match the selector (see _getSelector) and
+are not newer than max_time (None: all). Prepare their metrics with the derive
+state of their batch. Requires the shard lock. 
+Return a list of (deadline, target, metrics).
+"""
+def _takeSelected(shard, match, max_time=None):
+  taken = []
+  for batch in shard.batches.values():
+    if batch.count == 0:
+      continue
+
+    selected = _Batch(batch.target)
+    selected.derive = batch.derive # rates continue with the remaining values
+    for plugin_name, tags in batch.values.items():
+      for tag in list(tags):
+        keep = []
+        for valueList in tags[tag]:
+          if (match is None or match(valueList)) and (max_time is None or valueList.time <= max_time):
+            selected.values.setdefault(plugin_name, {}).setdefault(tag, []).append(valueList)
+            selected.count += 1
+          else:
+            keep.append(valueList)
+
+        if keep:
+          tags[tag] = keep
+        else:
+          del tags[tag]
+
+    if selected.count == 0:
+      continue
+
+    collectd.info('InfluxDB write: flush %d of %d series to %s' % (selected.count, batch.count, batch.target[0]))
+
+    batch.count -= selected.count
+    shard.count -= selected.count
+    if batch.count == 0:
+      batch.clear()
+
+    taken.append((batch.deadline, batch.target, _prepare_metrics(selected)))
+
+  return taken
+
+"""
+Get a function that checks whether a value list matches the given selector:
+a collectd identifier (host/plugin[-instance]/type[-instance]) with shell-style 
+wildcards or 'jobid=<ID>'. Missing parts of the identifier match everything.
+"""
+def _getSelector(identifier):
+  if identifier.startswith('jobid='):
+    jobid = identifier[len('jobid='):]
+    def matchJob(valueList):
+      return bool(valueList.meta) and jobid in valueList.meta.get('jobid', '').split(',')
+    return matchJob
+
+  parts = (identifier.split('/') + ['*', '*', '*'])[:3]
+
+  # host names may contain '-', only plugin and type have an instance
+  patterns = [(parts[0] or '*', None)]
+  for part in parts[1:]:
+    name, sep, instance = part.partition('-')
+    patterns.append((name or '*', instance if sep else None))
+
+  def matchIdentifier(valueList):
+    for (name, instance), (vlName, vlInstance) in zip(patterns, 
+        ((valueList.host, None), (valueList.plugin, valueList.plugin_instance), 
+         (valueList.type, valueList.type_instance))):
+      if not fnmatchcase(vlName or '', name):
+        return False
+      if instance is not None and not fnmatchcase(vlInstance or '', instance):
+        return False
+    return True
+
+  return matchIdentifier
+
+"""
+Send the selected batches of all shards (default: all batches) and the 
+backlogs of all targets.
+"""
+def _send(select=None):
+  taken = []
+  for shard in shards:
+    with shard.lock:
+      taken.extend(_takeBatches(shard, select))
+
+  for deadline, target, metrics in taken:
+    _deliver(target, metrics)
+
+  with backlog_lock:
+    keys = list(backlogs)
+  for destination, target in keys:
+    _sendBacklog(target, destination)
+
+"""
+Write points to the given target. Points are either dictionaries or line 
+protocol lines (protocol 'line'). 
+Return True on success and False, if the points could not be sent now.
+"""
+def _writePoints(target, points, protocol='json'):
+  local.write_error = None
+
+  # server asked us to back off or rate limit is reached
+  if not _rateLimitAllows():
+    return False
+
+  influx = _getClient()
+  if not influx:
+    return False
+
+  db, rp = target
+  local.last_response = None
+  try:
+    influx.write_points(points, time_precision=time_precision, 
+                        database=db, retention_policy=rp, protocol=protocol)
+    _adaptRate(True, len(points))
+  except Exception as ex: # batch could not be sent
+    # InfluxDBClientError provides the status code, if the response hook is not available
+    status = local.last_response[0] if local.last_response else getattr(ex, 'code', None)
+    local.write_error = status
+    _adaptRate(False, len(points), status)
+    collectd.error("InfluxDB write: error sending metrics(%s)" % (ex,))
+    return False
+
+  return True
+
+"""
+Check whether the last failed write of this thread was rejected by the server 
+because of bad data (status 400, e.g. a field type conflict). Rejected points 
+are not sent again, as they would fail again. Other errors (e.g. 401, 403 or 
+404 for a database that does not exist yet) are retried from the backlog.
+"""
+def _writeRejected():
+  return getattr(local, 'write_error', None) in REJECTED_STATUS_CODES
+
+"""
+Seal the open backlog chunk: serialize and compress its points. 
+Requires the backlog lock.
+"""
+def _sealBacklogChunk(backlog):
+  global backlog_bytes
+
+  if not backlog.open_chunk:
     return
 
-  # Send data to InfluxDB (len(metrics) <= batch_count as NaN and inf are not moved from batch to metrics)
-  collectd.info('InfluxDB write: %d lines (%d series)' % (len(metrics), batch_count))
-  #collectd.info('InfluxDB write: %d lines (%d series incl. %d rates), %d aggregated' % (len(metrics), batch_count, len(batch_derive), num_aggregated) )
-  #collectd.info(str(metrics))
+  block = influx_archive.encode_block(backlog.open_chunk, codec=conf_backlog_compression)
+  backlog.chunks.append((backlog.open_window, block, len(backlog.open_chunk)))
+  backlog_bytes += len(block)
+  backlog.open_chunk = []
+  backlog.open_window = None
 
-  ret = False
+  # evict the oldest chunks (of all targets), if the backlog memory is exceeded
+  while backlog_bytes > conf_backlog_size:
+    oldest = min((b for b in backlogs.values() if b.chunks), key=lambda b: b.chunks[0][0])
+    window, block, num_points = oldest.chunks.popleft()
+    backlog_bytes -= len(block)
+    collectd.warning("InfluxDB write: backlog size exceeded. Discarding %d points." % (num_points,))
 
-  if influx:
-    try:
-      ret = influx.write_points(metrics, time_precision=time_precision)
-    except Exception as ex: # batch could not be sent
-      collectd.error("InfluxDB write: error sending metrics(%s)" % (ex,))
-
-      # derived metrics batch is created again from metrics in current batch
-      batch_derive = {} 
-
-      # increase batch size (but not above the configured cache size)
-      batch_size += conf_batch_size
-      if batch_size > conf_cache_size:
-        batch_size = conf_cache_size
-
-  # empty batch buffer for successful writes
-  if ret:
-    #collectd.info("reset batch")
-    batch = {}
-    batch_count = 0
-    batch_size = conf_batch_size
-    #num_aggregated = 0
+"""
+Add points that could not be sent to InfluxDB (or written to the archive) to 
+the backlog of the target.
+"""
+def _addToBacklog(target, points, destination='influx'):
+  with backlog_lock:
+    backlog = backlogs.get((destination, target))
+    if backlog is None:
+      backlog = _Backlog()
+      backlogs[(destination, target)] = backlog
+
+    for point in points:
+      window = point['time'] // conf_backlog_window
+      if window != backlog.open_window:
+        _sealBacklogChunk(backlog)
+        backlog.open_window = window
+      backlog.open_chunk.append(point)
+
+"""
+Send the backlog of a target (oldest chunks first) to InfluxDB or write it to 
+the archive (destination), as long as writes succeed.
+The lock is not held while sending.
+"""
+def _sendBacklog(target, destination='influx'):
+  global backlog_bytes
+
+  while True:
+    with backlog_lock:
+      backlog = backlogs.get((destination, target))
+      if backlog is None:
+        return
+      _sealBacklogChunk(backlog)
+      if not backlog.chunks:
+        return
+      chunk = backlog.chunks.popleft()
+      backlog_bytes -= len(chunk[1])
+
+    window, block, num_points = chunk
+    if destination == 'archive':
+      written = _writeArchive(target, list(influx_archive.points([influx_archive.decode(block)])))
+      if not written:
+        with backlog_lock:
+          backlog.chunks.appendleft(chunk)
+          backlog_bytes += len(block)
+        return
+
+      collectd.info("InfluxDB write: archived %d points from backlog" % (num_points,))
+      continue
+
+    lines = list(influx_archive.lines([influx_archive.decode(block)]))
+    if not _writePoints(target, lines, protocol='line'):
+      if _writeRejected():
+        collectd.error("InfluxDB write: server rejected backlog chunk (status %d). Discarding %d points." 
+                       % (local.write_error, num_points))
+        continue
+
+      # put the chunk back (it is evicted first, if the backlog is full)
+      with backlog_lock:
+        backlog.chunks.appendleft(chunk)
+        backlog_bytes += len(block)
+      return
+
+    collectd.info("InfluxDB write: sent %d points from backlog" % (num_points,))
+
+"""
+Write points of a target to the archive. Return True on success.
+"""
+def _writeArchive(target, points):
+  try:
+    with archive_lock:
+      archive_writer.write(target, points)
+  except (IOError, OSError) as ex:
+    collectd.error("InfluxDB write: error writing archive (%s)" % (ex,))
+    return False
+
+  return True
+
+"""
+Write prepared points of a target to the archive and/or InfluxDB. Points that
+cannot be sent to InfluxDB or written to the archive are kept in the backlog 
+(one per destination).
+"""
+def _deliver(target, metrics):
+  if not metrics:
+    return
+
+  if ring_store:
+    ring_store.add(metrics)
+
+  if archive_writer:
+    if _writeArchive(target, metrics):
+      _sendBacklog(target, 'archive')
+    else:
+      collectd.error("InfluxDB write: keep %d points in the archive backlog" % (len(metrics),))
+      _addToBacklog(target, metrics, 'archive')
+
+  if output != 'archive':
+    if _writePoints(target, metrics):
+      _sendBacklog(target)
+    elif _writeRejected():
+      collectd.error("InfluxDB write: server rejected metrics (status %d). Discarding %d points." 
+                     % (local.write_error, len(metrics)))
+    else:
+      _addToBacklog(target, metrics)
 
-def _prepare_metrics():
-  global batch
+def _prepare_metrics(batch):
+  batch_derive = batch.derive
 
   # build metrics data
   metrics = []
-  for measurement in batch:
-    for tag in batch[measurement]:
+  for measurement in batch.values:
+    for tag in batch.values[measurement]:
       last_time = -1
       fields = {}
 
       # iterate over the value lists
-      for valueList in batch[measurement][tag]:
+      for valueList in batch.values[measurement][tag]:
         counterMetricID = None # default is a gauge metric type, no metric ID needed
 
         time = int(valueList.time)
@@ -277,6 +846,9 @@ def _prepare_metrics():
           else:
             tags[measurement] = tag
 
+        if valueList.meta and 'jobid' in valueList.meta:
+          tags['jobid'] = valueList.meta['jobid']
+
         # determine metric name
         metricName = valueList.type_instance
         if metricName is None or metricName == '':
@@ -384,6 +956,316 @@ def _prepare_metrics():
 
   return metrics
 
+"""
+Get the target (database, retention policy) for the given plugin name. The
+first matching route wins. Plugins without a matching route are written to
+the default database with its default retention policy.
+"""
+def _getTarget(plugin_name):
+  target = target_cache.get(plugin_name)
+  if target is None:
+    target = (database, None)
+    for pattern, route_db, route_rp in routes:
+      if pattern.match(plugin_name):
+        target = (route_db or database, route_rp)
+        break
+
+    target_cache[plugin_name] = target
+
+  return target
+
+"""
+Get the latency class (name, maximum delay) for the given plugin name.
+"""
+def _getLatencyClass(plugin_name):
+  latency_class = class_cache.get(plugin_name)
+  if latency_class is None:
+    latency_class = ('default', default_max_delay)
+    for name, max_delay, patterns in latency_classes:
+      if any(pattern.match(plugin_name) for pattern in patterns):
+        latency_class = (name, max_delay)
+        break
+
+    class_cache[plugin_name] = latency_class
+
+  return latency_class
+
+"""
+Check, whether the given plugin has a low priority (see LowPriority).
+"""
+def _isLowPriority(plugin_name):
+  low = priority_cache.get(plugin_name)
+  if low is None:
+    low = any(pattern.match(plugin_name) for pattern in low_priority)
+    priority_cache[plugin_name] = low
+
+  return low
+
+"""
+Add the value list to the rollup of its series (the plugin instance before the
+mapping to cores). Rollup windows are half-open intervals [start, start + 
+interval) aligned to multiples of the rollup interval. Return the value list 
+with the rollup values of the previous window (mean of gauges, last value of 
+other types), when the first value list of a later window arrives, otherwise 
+None. Requires the shard lock.
+"""
+def _rollup(shard, valueList, instance, is_per_core):
+  key = (valueList.plugin, instance, valueList.type, valueList.type_instance)
+  start = valueList.time - valueList.time % conf_rollup_interval
+  rollup = shard.rollups.get(key)
+  complete = None
+  if rollup is not None and rollup[0] != start:
+    complete = _rollupValueList(rollup)
+    rollup = None
+
+  if rollup is None:
+    rollup = [start, 0, [0.0] * len(valueList.values), None, is_per_core]
+    shard.rollups[key] = rollup
+
+  rollup[1] += 1
+  for idx, value in enumerate(valueList.values):
+    if idx < len(rollup[2]):
+      rollup[2][idx] += value
+  rollup[3] = valueList
+
+  return complete
+
+def _rollupValueList(rollup):
+  start, count, sums, valueList, is_per_core = rollup
+  ds = collectd.get_dataset(valueList.type)
+  values = list(valueList.values)
+  for idx in range(min(len(values), len(sums))):
+    if ds[idx][1] == 'gauge':
+      values[idx] = sums[idx] / count
+  valueList.values = values
+  return valueList
+
+"""
+Add the thread CPU time since start to the used budget. At the end of a 
+budget interval, switch to the next cheaper mode, if the budget was exceeded,
+or back to the previous mode, if less than half of the budget was used.
+"""
+def _account(start):
+  if conf_cpu_budget <= 0:
+    return
+
+  used = time.thread_time() - start
+  with budget_lock:
+    global budget_used
+    global budget_start
+    global budget_level
+    budget_used += used
+    now = time.monotonic()
+    if budget_start == 0:
+      budget_start = now
+    elapsed = now - budget_start
+    if elapsed < conf_budget_interval or elapsed <= 0:
+      return
+
+    usage = budget_used / elapsed
+    if usage > conf_cpu_budget and budget_level < len(BUDGET_LEVELS) - 1:
+      budget_level += 1
+      collectd.warning("InfluxDB write: CPU usage %.3f%% exceeds budget %.3f%%, switch to mode '%s'"
+                       % (usage * 100, conf_cpu_budget * 100, BUDGET_LEVELS[budget_level]))
+    elif usage < conf_cpu_budget / 2 and budget_level > 0:
+      budget_level -= 1
+      collectd.info("InfluxDB write: CPU usage %.3f%% within budget %.3f%%, switch to mode '%s'"
+                    % (usage * 100, conf_cpu_budget * 100, BUDGET_LEVELS[budget_level]))
+
+    budget_used = 0.0
+    budget_start = now
+
+"""
+Get the batch of a shard for the latency class and target of the given plugin 
+name (create it, if needed). Requires the shard lock.
+"""
+def _getBatch(shard, plugin_name):
+  name, max_delay = _getLatencyClass(plugin_name)
+  target = _getTarget(plugin_name)
+  batch = shard.batches.get((name, target))
+  if batch is None:
+    batch = _Batch(target, name, max_delay)
+    shard.batches[(name, target)] = batch
+    collectd.info("InfluxDB write: new batch for class %s, database %s, retention policy %s" 
+                  % (name, target[0], target[1]))
+
+  return batch
+
+"""
+Sender thread: send batches of latency classes, when their deadline is reached.
+Batches are sent in the order of their deadlines.
+"""
+def _senderLoop():
+  while True:
+    with sender_condition:
+      if not sender_running:
+        return
+
+      now = time.monotonic()
+      deadlines = [b.deadline for shard in shards for b in list(shard.batches.values()) 
+                   if b.deadline is not None]
+      if not deadlines or min(deadlines) > now:
+        sender_condition.wait(min(deadlines) - now if deadlines else None)
+        continue
+
+    # take due batches without holding the condition lock
+    start = time.thread_time()
+    due = lambda b: b.deadline is not None and b.deadline <= now
+    taken = []
+    for shard in shards:
+      with shard.lock:
+        taken.extend(_takeBatches(shard, due))
+
+    for deadline, target, metrics in sorted(taken, key=lambda t: t[0]):
+      _deliver(target, metrics)
+
+    _account(start)
+
+"""
+Start the sender thread, if latency classes with a maximum delay are used.
+"""
+def _startSender():
+  if default_max_delay is None and not latency_classes:
+    return
+
+  global sender_thread
+  global sender_running
+  sender_running = True
+  sender_thread = threading.Thread(target=_senderLoop, name='influx_write sender')
+  sender_thread.daemon = True
+  sender_thread.start()
+
+"""
+Stop the sender thread.
+"""
+def _stopSender():
+  global sender_running
+  if sender_thread is None:
+    return
+
+  with sender_condition:
+    sender_running = False
+    sender_condition.notify()
+  sender_thread.join()
+
+"""
+Parse a cpuset list (e.g. '0-3,8,10-11'). Return a list of CPU IDs.
+"""
+def _parseCpuList(cpuList):
+  cpus = []
+  for part in cpuList.strip().split(','):
+    if not part:
+      continue
+    if '-' in part:
+      first, last = part.split('-', 1)
+      cpus.extend(range(int(first), int(last) + 1))
+    else:
+      cpus.append(int(part))
+  return cpus
+
+"""
+Read the job directories. Return a tuple (HW thread -> job ID, list of the job 
+IDs of the node).
+"""
+def _readJobs():
+  cpu_jobs = {}
+  jobs = []
+  for pattern in job_paths:
+    for path in glob.glob(pattern):
+      match = jobIdPattern.match(os.path.basename(path))
+      if not match:
+        continue
+
+      jobid = match.group(1)
+      if jobid not in jobs:
+        jobs.append(jobid)
+
+      for cpus_file in ('cpuset.cpus.effective', 'cpuset.cpus'):
+        try:
+          with open(os.path.join(path, cpus_file), 'r') as f:
+            cpus = _parseCpuList(f.read())
+        except (IOError, ValueError):
+          continue
+
+        for cpu in cpus:
+          cpu_jobs.setdefault(cpu, jobid)
+        break
+
+  jobs.sort(key=int)
+  return cpu_jobs, jobs
+
+"""
+Return the modification times of the directories, which contain the job 
+directories (they change, when a job directory is created or removed).
+"""
+def _getJobDirMtimes():
+  mtimes = {}
+  for pattern in job_paths:
+    for path in glob.glob(os.path.dirname(pattern)):
+      try:
+        mtimes[path] = os.stat(path).st_mtime_ns
+      except OSError:
+        continue
+  return mtimes
+
+"""
+Update the job map, if the job directories changed (or force is True). 
+Only one thread checks at a time, the others keep using the current map. A 
+forced check during a running check is repeated by the running thread.
+"""
+def _checkJobs(force=False):
+  global job_map
+  global job_dir_mtimes
+  global jobs_next_check
+  global jobs_dirty
+
+  if force:
+    jobs_dirty = True
+
+  while True:
+    if not jobs_lock.acquire(False):
+      return
+
+    try:
+      jobs_next_check = time.monotonic() + job_check_interval
+      force = jobs_dirty
+      jobs_dirty = False
+
+      mtimes = _getJobDirMtimes()
+      if force or mtimes != job_dir_mtimes:
+        job_dir_mtimes = mtimes
+        job_map = _readJobs()
+        collectd.info("InfluxDB write: jobs on node: %s" % (','.join(job_map[1]) or None,))
+    finally:
+      jobs_lock.release()
+
+    # a forced check, which arrived after the map was read
+    if not jobs_dirty:
+      return
+
+"""
+Store the job ID of a value list in its meta data. For per-CPU plugins 
+(plugin name ends with 'cpu') it is the job of the CPU (plugin instance), 
+otherwise the job of the node. Values of the node are not tagged, if several 
+(or no) jobs run on the node.
+"""
+def _setJobId(valueList):
+  if time.monotonic() >= jobs_next_check:
+    _checkJobs()
+
+  cpu_jobs, node_jobs = job_map
+  jobid = node_jobs[0] if len(node_jobs) == 1 else None
+  if valueList.plugin.endswith('cpu') and valueList.plugin_instance:
+    try:
+      jobid = cpu_jobs.get(int(valueList.plugin_instance))
+    except ValueError:
+      pass
+
+  if jobid:
+    if valueList.meta is None:
+      valueList.meta = {}
+    valueList.meta['jobid'] = jobid
+
 """
 Extract integer value from string
 """
@@ -428,12 +1310,107 @@ def set_config(config):
         database = value.values[0]
       elif value.key == 'batch_size': 
         global conf_batch_size
-        global batch_size
         conf_batch_size = _getInteger(value.values[0])
-        batch_size = conf_batch_size
       elif value.key == 'cache_size':
         global conf_cache_size
         conf_cache_size = _getInteger(value.values[0])
+      elif value.key == 'JobIdTag':
+        global jobid_tag
+        jobid_tag = value.values[0]
+      elif value.key == 'JobPath':
+        global job_paths
+        if job_paths is None:
+          job_paths = []
+        job_paths.extend(value.values)
+      elif value.key == 'job_check_interval':
+        global job_check_interval
+        job_check_interval = float(value.values[0])
+      elif value.key == 'shards':
+        global conf_shards
+        conf_shards = int(value.values[0])
+      elif value.key == 'backlog_size':
+        global conf_backlog_size
+        conf_backlog_size = _getInteger(value.values[0])
+      elif value.key == 'backlog_window':
+        global conf_backlog_window
+        conf_backlog_window = int(value.values[0])
+      elif value.key == 'backlog_compression':
+        global conf_backlog_compression
+        conf_backlog_compression = value.values[0]
+        if conf_backlog_compression == 'lz4' and influx_archive.lz4frame is None:
+          collectd.info("InfluxDB write: lz4 module not available. Use zlib compression.")
+          conf_backlog_compression = 'zlib'
+      elif value.key == 'LatencyClass':
+        # LatencyClass "<name>" <maximum delay in seconds> ["<plugin regex>" ...]
+        if len(value.values) < 2:
+          collectd.error("InfluxDB write: LatencyClass requires a name and a maximum delay")
+          continue
+        name = value.values[0]
+        max_delay = float(value.values[1])
+        if name == 'default':
+          global default_max_delay
+          default_max_delay = max_delay
+        else:
+          patterns = [re.compile(pattern) for pattern in value.values[2:]]
+          latency_classes.append((name, max_delay, patterns))
+        collectd.info("InfluxDB write: latency class %s for plugins %s (maximum delay: %.1fs)"
+                      % (name, value.values[2:], max_delay))
+      elif value.key == 'cpu_budget':
+        global conf_cpu_budget
+        conf_cpu_budget = float(value.values[0])
+        if conf_cpu_budget > 0:
+          collectd.info("InfluxDB write: CPU budget %.3f%%" % (conf_cpu_budget * 100,))
+      elif value.key == 'budget_interval':
+        global conf_budget_interval
+        conf_budget_interval = float(value.values[0])
+      elif value.key == 'rollup_interval':
+        global conf_rollup_interval
+        conf_rollup_interval = float(value.values[0])
+      elif value.key == 'LowPriority':
+        # LowPriority "<plugin regex>" ...
+        low_priority.extend(re.compile(pattern) for pattern in value.values)
+      elif value.key == 'output':
+        global output
+        output = value.values[0]
+        if output not in ('influx', 'archive', 'both'):
+          collectd.error("InfluxDB write: unknown output '%s'. Use 'influx'." % (output,))
+          output = 'influx'
+      elif value.key == 'archive_directory':
+        global archive_directory
+        archive_directory = value.values[0]
+      elif value.key == 'archive_window':
+        global archive_window
+        archive_window = int(value.values[0])
+      elif value.key == 'ring_minutes':
+        global ring_minutes
+        ring_minutes = float(value.values[0])
+      elif value.key == 'ring_interval':
+        global ring_interval
+        ring_interval = int(value.values[0])
+      elif value.key == 'ring_socket':
+        global ring_socket
+        ring_socket = value.values[0]
+      elif value.key == 'ring_socket_perms':
+        global ring_socket_perms
+        ring_socket_perms = int(str(value.values[0]), 8)
+      elif value.key == 'Route':
+        # Route "<plugin regex>" "<database>" ["<retention policy>"]
+        if len(value.values) < 2:
+          collectd.error("InfluxDB write: Route requires a plugin pattern and a database")
+          continue
+        route_rp = value.values[2] if len(value.values) > 2 else None
+        routes.append((re.compile(value.values[0]), value.values[1], route_rp))
+        collectd.info("InfluxDB write: route plugins '%s' to database %s, retention policy %s"
+                      % (value.values[0], value.values[1], route_rp))
+      elif value.key == 'max_points_per_second':
+        global conf_max_points_rate
+        conf_max_points_rate = float(value.values[0])
+      elif value.key == 'max_bytes_per_second':
+        global conf_max_bytes_rate
+        conf_max_bytes_rate = float(value.values[0])
+      elif value.key == 'latency_target':
+        global conf_latency_target
+        conf_latency_target = float(value.values[0])
       elif value.key == 'StoreRates':
         global store_rates
         store_rates = value.values[0]
@@ -463,20 +1440,74 @@ Collectd initialization callback.
 Responsible for starting the sending thread
 """
 def init_callback():
+  if jobid_tag:
+    global job_paths
+    if job_paths is None:
+      job_paths = DEFAULT_JOB_PATHS
+    _checkJobs(True)
+
+  global shards
+  shards = [_Shard() for i in range(max(1, conf_shards))]
+  if len(shards) > 1:
+    collectd.info("InfluxDB write: collect values in %d shards" % (len(shards),))
+
+  if ring_minutes > 0:
+    global ring_store
+    global ring_server
+    ring_store = influx_ring.SeriesStore(ring_minutes * 60, ring_interval)
+    collectd.info("InfluxDB write: keep %g minutes of metrics in ring buffer" % (ring_minutes,))
+    if ring_socket:
+      try:
+        ring_server = influx_ring.QueryServer(ring_store, ring_socket, 
+                                              lambda msg: collectd.warning("InfluxDB write: ring buffer " + msg),
+                                              ring_socket_perms)
+        ring_server.start()
+        collectd.info("InfluxDB write: query ring buffer at %s" % (ring_socket,))
+      except (IOError, OSError) as ex:
+        collectd.error("InfluxDB write: cannot create ring buffer socket %s (%s)" % (ring_socket, ex))
+
+  if output != 'influx':
+    global archive_writer
+    if archive_directory is None:
+      collectd.error("InfluxDB write: archive output requires 'archive_directory'")
+    else:
+      try:
+        archive_writer = influx_archive.ArchiveWriter(archive_directory, archive_window, time_precision)
+        collectd.info("InfluxDB write: write archive files to %s" % (archive_directory,))
+      except (IOError, OSError) as ex:
+        collectd.error("InfluxDB write: cannot create archive directory %s (%s)" % (archive_directory, ex))
+
+    # no connection to InfluxDB needed
+    if output == 'archive':
+      _startSender()
+      return
+
   global InfluxDBClient
   if not InfluxDBClient:
     collectd.info('InfluxDB write: influxdb.client.InfluxDBClient import failed.')
   else:
     #collectd.info('[InfluxDB Writer] Initialize.')
+    global points_bucket
+    global bytes_bucket
+    if conf_max_points_rate > 0:
+      points_bucket = _TokenBucket(conf_max_points_rate)
+    if conf_max_bytes_rate > 0:
+      bytes_bucket = _TokenBucket(conf_max_bytes_rate)
+    if points_bucket or bytes_bucket:
+      collectd.info("InfluxDB write: limit send rate to %s points/s and %s bytes/s" 
+                    % (conf_max_points_rate or 'unlimited', conf_max_bytes_rate or 'unlimited'))
+
     _connect()
 
+  _startSender()
+
 
 """
 Collectd write callback.
 Retrieves values from read plugins.
 """
 def write(valueList, data=None):
-  if not InfluxDBClient:
+  if not InfluxDBClient and not archive_writer:
     return
 
   #collectd.info('InfluxDB write: %s' % (str(valueList),))
@@ -487,47 +1518,165 @@ def write(valueList, data=None):
   # where values from different HW threads have differ in the fractional part
   # of the timestamp)
   vlTime = int(valueList.time)
-  global currentTimestamp
-  if currentTimestamp == 0:
-    currentTimestamp = vlTime
-    #collectd.info("InfluxDB write: group time {:d}".format(currentTimestamp))
-
-  # check for changed timestamp before sending to make sure that all values in
-  # current time period (second) are aggregated
-  global batch_count
-  global batch_size
-  if currentTimestamp != vlTime:
-    currentTimestamp = vlTime
-    #collectd.info("InfluxDB write: group time {:d}".format(currentTimestamp))
-    if batch_count >= batch_size: 
-      #collectd.info("InfluxDB write: sending batch of {:d}".format(batch_count))
-      _send()
-
-  # Add data to global batch
-  if batch_count <= conf_cache_size:
-    if _collect(valueList):
-      batch_count += 1
-      #collectd.info("batch count: " + str(batch_count))
+
+  if not valueList.plugin: 
+    collectd.error('InfluxDB writer: plugin member is required!')
+    return
+
+  level = budget_level
+  if level >= 2 and low_priority and _isLowPriority(valueList.plugin):
+    return
+
+  start = time.thread_time()
+
+  # job ID is determined by the plugin instance before mapping it to the core
+  if jobid_tag:
+    _setJobId(valueList)
+
+  tag = instance = valueList.plugin_instance
+
+  # first check for the tag, which is None for many plugins
+  is_per_core = tag and per_core_plugins and valueList.plugin in per_core_plugins
+
+  # map to core (before selecting the shard, values of a core are summed up)
+  if is_per_core:
+    #collectd.info("value: " + str(valueList))
+    tag = coreMapping[int(tag)]
+    valueList.plugin_instance = tag
+
+  if len(shards) == 1:
+    shard = shards[0]
   else:
-    collectd.info("InfluxDB write error: Metric cache exceeded. Discarding {:d} metrics".format(batch_count))
+    shard = shards[hash((valueList.plugin, tag)) % len(shards)]
+
+  # larger batches (fewer requests) from budget level 'large batches'
+  factor = LARGE_BATCH_FACTOR if level >= 1 else 1
+
+  full = None
+  with shard.lock:
+    # check for changed timestamp before sending to make sure that all values in
+    # current time period (second) are aggregated
+    if shard.timestamp == 0:
+      shard.timestamp = vlTime
+      #collectd.info("InfluxDB write: group time {:d}".format(shard.timestamp))
+
+    if shard.timestamp != vlTime:
+      shard.timestamp = vlTime
+      #collectd.info("InfluxDB write: group time {:d}".format(shard.timestamp))
+      if any(batch.count >= batch.size * factor for batch in shard.batches.values()):
+        #collectd.info("InfluxDB write: sending full batches")
+        full = _takeBatches(shard, lambda batch: batch.count >= batch.size * factor)
+
+    collect = [(valueList, is_per_core)]
+    if level >= 3:
+      valueList = _rollup(shard, valueList, instance, is_per_core)
+      collect = [(valueList, is_per_core)] if valueList else []
+    elif shard.rollups:
+      # collect incomplete rollups after leaving mode 'rollups only'
+      collect = [(_rollupValueList(r), r[4]) for r in shard.rollups.values()] + collect
+      shard.rollups = {}
+
+    # Add data to the batch of the value's latency class and target
+    if shard.count <= conf_cache_size * factor // len(shards):
+      for valueList, is_per_core in collect:
+        if _collect(valueList, _getBatch(shard, valueList.plugin), is_per_core):
+          shard.count += 1
+          #collectd.info("batch count: " + str(shard.count))
+    else:
+      collectd.info("InfluxDB write error: Metric cache exceeded. Discarding {:d} metrics".format(shard.count))
+
+      for batch in shard.batches.values():
+        batch.clear()
+        batch.derive = {}
+      shard.count = 0
 
-    global batch
-    global batch_derive
-    batch = {}
-    batch_count = 0
-    batch_size = conf_batch_size
-    batch_derive = {}
+  # send without holding the shard lock
+  if full:
+    for deadline, target, metrics in full:
+      _deliver(target, metrics)
+
+  _account(start)
 
   
-def flush(timeout, identifier):
-  global batch_count
-  collectd.info("InfluxDB write: flush {:d} values".format(batch_count))
+"""
+Collectd flush callback. Only values matching the identifier (see _getSelector)
+and older than timeout seconds are sent. Without identifier and timeout, all 
+values and the backlogs are sent.
+"""
+def flush(timeout=-1, identifier=None, data=None):
+  start = time.thread_time()
+  if not identifier and (timeout is None or timeout <= 0):
+    collectd.info("InfluxDB write: flush {:d} values".format(sum(shard.count for shard in shards)))
+
+    # Send pickled batch
+    _send()
+    _finalizeArchive()
+    _account(start)
+    return
+
+  match = _getSelector(identifier) if identifier else None
+  max_time = time.time() - timeout if timeout is not None and timeout > 0 else None
+
+  taken = []
+  for shard in shards:
+    with shard.lock:
+      taken.extend(_takeSelected(shard, match, max_time))
+
+  for deadline, target, metrics in taken:
+    _deliver(target, metrics)
+
+  _finalizeArchive()
+  _account(start)
+
+"""
+Complete the archive files of ended windows, also without new points.
+"""
+def _finalizeArchive():
+  if not archive_writer:
+    return
+
+  try:
+    with archive_lock:
+      archive_writer.finalize_ended()
+  except (IOError, OSError) as ex:
+    collectd.error("InfluxDB write: error completing archive files (%s)" % (ex,))
+
+"""
+Handle notifications, e.g. update the job map, when a job starts or ends 
+(from Slurm prolog/epilog) or flush the values of a job:
+echo "PUTNOTIF severity=okay time=$(date +%s) plugin=influx_write message=jobs" | socat - UNIX-CLIENT:collectdSocketFile.sock
+echo "PUTNOTIF severity=okay time=$(date +%s) plugin=influx_write message=\"flush jobid=1234\"" | socat - UNIX-CLIENT:collectdSocketFile.sock
+"""
+def notify(notification, data=None):
+  if notification.plugin is None or notification.plugin == "" or notification.plugin == "influx_write":
+    if notification.message == "jobs":
+      if jobid_tag:
+        _checkJobs(True)
+    elif notification.message == "flush" or notification.message.startswith("flush "):
+      # "flush [<identifier>|jobid=<ID>]"
+      identifier = notification.message[len("flush"):].strip()
+      collectd.info("InfluxDB write: flush %s" % (identifier or "all",))
+      flush(-1, identifier or None)
+
+"""
+Collectd shutdown callback. Send remaining data and complete archive files.
+"""
+def shutdown():
+  _stopSender()
 
-  # Send pickled batch
   _send()
+
+  if archive_writer:
+    with archive_lock:
+      archive_writer.close()
+
+  if ring_server:
+    ring_server.stop()
     
 # register Collectd callbacks
 collectd.register_config(set_config)
 collectd.register_write(write)
 collectd.register_init(init_callback)
 collectd.register_flush(flush)
+collectd.register_shutdown(shutdown)
+collectd.register_notification(notify)
@@ -7,13 +7,21 @@ Collect data from Lustre file systems.
 Author: Robert Dietrich (robert.dietrich@tu-dresden.de)
 
 Dependencies:
-[subprocess](http://docs.python.org/library/subprocess.html)
+[subprocess](http://docs.python.org/library/subprocess.html) (only, if the 
+mount of a Lustre instance cannot be determined from /proc/self/mountinfo)
 """
 
 import time
 import os
 import sys
+import math
+import re
 import subprocess
+import select
+import fcntl
+import threading
+import glob
+from concurrent.futures import ThreadPoolExecutor, wait
 
 try:
   import collectd
@@ -25,12 +33,6 @@ except ImportError:
 from subprocess import Popen, PIPE, STDOUT
 
 ### constants ###
-# number of list entries per Lustre instance and positions
-FS_ENTRIES = 3
-POS_STATS_FILE = 0 # not used
-POS_FSNAME = 1
-POS_PREV_DATA = 2
-
 # Lustre meta data operations
 KEY_MAPPING = [
   'open',
@@ -40,12 +42,90 @@ KEY_MAPPING = [
   'seek'
 ]
 
+# data sources of the multi-value type 'lustre' (see custom_types.db)
+LUSTRE_TYPE = 'lustre'
+LUSTRE_DERIVE_TYPE = 'lustre_derive' # same data sources as counters (derive)
+LUSTRE_TYPE_FIELDS = ('read_bw', 'write_bw', 'read_requests', 'write_requests', 
+                      'open', 'close', 'fsync', 'create', 'seek')
+
+# Lustre counters are unsigned 64 bit values, a smaller value than before is a 
+# wrap, if the previous value was in the upper half of the range (otherwise a reset)
+COUNTER_MAX = 2**64
+COUNTER_WRAP_THRESHOLD = 2**63
+
+# suffix of metrics with the average latency (microseconds) of an operation
+LATENCY_SUFFIX = '_latency'
+
 # Lustre stats files are located depending on the Lustre version
 # make sure that the paths end with a slash
 DEFAULT_LUSTRE_SEARCH_PATHS = [
   '/sys/kernel/debug/lustre/llite/',
   '/proc/fs/lustre/llite/'
 ]
+
+# client side Lustre targets (OSC per OST, MDC per MDT) are located in 
+# subdirectories 'osc' and 'mdc' of these paths (files can be split among them)
+DEFAULT_TARGET_SEARCH_PATHS = [
+  '/sys/kernel/debug/lustre/',
+  '/proc/fs/lustre/'
+]
+
+# files per target type
+TARGET_FILES = {
+  'osc': ('stats', 'import', 'rpc_stats'),
+  'mdc': ('md_stats', 'import')
+}
+
+# data sources of the multi-value types per target (see custom_types.db): rates 
+# of the counters and current values of the import file (type 'lustre_target') 
+# and rates of the metadata operations of an MDC (type 'lustre_mdc')
+TARGET_TYPE = 'lustre_target'
+TARGET_TYPE_FIELDS = ('read_bw', 'write_bw', 'read_requests', 'write_requests', 'rpcs', 
+                      'connected', 'inflight', 'timeouts', 'avg_waittime')
+TARGET_VALUE_FIELDS = ('connected', 'inflight', 'timeouts', 'avg_waittime')
+MDC_TYPE = 'lustre_mdc'
+MDC_TYPE_FIELDS = ('close', 'create', 'enqueue', 'getattr', 'intent_lock', 'link', 
+                   'rename', 'setattr', 'fsync', 'read_page', 'unlink', 'setxattr', 
+                   'getxattr', 'statfs')
+
+# histogram types (see custom_types.db) with their number of buckets: 
+# pages per RPC (1, 2, 4, ... 4096), RPCs in flight (0, 1, 2-3, 4-7, ... 32+)
+# and extent sizes (0-4K, 4K-8K, 8K-16K, ... 4M+)
+HIST_RPC_PAGES = 'lustre_rpc_pages'
+HIST_RPC_FLIGHT = 'lustre_rpc_flight'
+HIST_EXTENTS = 'lustre_extents'
+HIST_BUCKETS = {
+  HIST_RPC_PAGES: 13,
+  HIST_RPC_FLIGHT: 7,
+  HIST_EXTENTS: 12
+}
+
+# sections of the rpc_stats file (header line -> histogram type)
+RPC_STATS_SECTIONS = {
+  'pages per rpc': HIST_RPC_PAGES,
+  'rpcs in flight': HIST_RPC_FLIGHT
+}
+
+# server side per job statistics of OSTs and MDTs
+DEFAULT_JOB_STATS_PATTERNS = {
+  'ost': '/proc/fs/lustre/obdfilter/*/job_stats',
+  'mdt': '/proc/fs/lustre/mdt/*/job_stats'
+}
+JOB_STATS_BUFFER_SIZE = 1 << 16 # bytes read at once from job_stats files
+
+# metrics of the high-frequency sampler
+SAMPLE_METRICS = ('read_bw', 'write_bw')
+
+# mounts of the process (Lustre mounts have the file system type 'lustre')
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+# seconds to wait for further mount changes, before the Lustre files are checked
+MOUNT_SETTLE_TIME = 1
+
+# ioctl of llapi_getname() on a Lustre mount: _IOR('f', 127, char[MAX_OBD_NAME]) 
+# returns the LOV name '<fsname>-clilov-<superblock>'
+OBD_IOC_GETDTNAME = 0x8080667f
+MAX_OBD_NAME = 128
 ### END: constants ###
 
 ### global variables ###
@@ -67,18 +147,97 @@ lustrePath = None
 # list of monitored Lustre instances
 lustreInstances = None
 
-# time stamp of previous value dispatch
-timePrev = 0
-
-# Lustre instances information list: 
-# FS_ENTRIES entries per instance (path to stats file, file system name, 
-# dict of last metrics values)
-fsInfo = []
+# monitored Lustre instances: instance name -> _LustreInstance
+instances = {}
         
 numReads = 0
 checkSourcesInterval = 0 # number of intervals/reads after re-checking available file systems (default is off: 0)
+
+# collect per target (OSC/MDC) statistics of the monitored instances
+targetStats = False
+targetThreads = 8   # number of threads reading the target files
+targetTimeout = 5   # seconds after which unfinished target reads are skipped
+targetExecutor = None
+
+# collect histograms of RPC sizes, RPCs in flight (osc rpc_stats) and extent
+# sizes (llite extents_stats, enable with 'lctl set_param llite.*.extents_stats=1')
+histograms = False
+
+# target directory name -> [file system name, target name (e.g. OST0001), 
+# dict of file name -> path, dict of last counter values, time of the last 
+# counter values, last histograms (rpc_stats), future of the pending read]
+targetInfo = {}
+
+# collect per job statistics on Lustre servers (OSS, MDS)
+jobStats = False
+jobExpire = 600 # seconds after which jobs not found in job_stats are removed
+
+# (plugin name, job ID) -> [dict of last counter values, time of last occurrence]
+jobInfo = {}
+jobTimePrev = 0
+
+# read the stats files every samplePeriod seconds in a background thread and
+# dispatch min/max/mean/p95 of the bandwidths per interval (0: disabled)
+samplePeriod = 0
+samplerThread = None
+samplerStop = threading.Event()
+
+# stats file -> [file system name, (time, metrics) of last sample, 
+# dict of metric -> list of rates in the current interval], protected by samplerLock
+samples = {}
+samplerLock = threading.Lock()
+
+# operations (lines) of the llite stats file, which are collected ('*': all)
+statsOps = ['read_bytes', 'write_bytes'] + KEY_MAPPING
+statsLatency = False # collect average latencies of operations (Lustre >= 2.12)
+
+# dispatch the metrics of the type 'lustre' as one value list per file system
+multiValue = False
+
+# dispatch the counters of the stats file as derive values instead of rates
+deriveValues = False
+
+# compiled parser for the selected lines of the stats file (see _compileStatsParser)
+statsPattern = None
+
+# check the Lustre files, when the mount table changes (replaces the periodic checks)
+watchMounts = True
+watcherThread = None
+watcherRunning = False
+
+# protects the Lustre instance data, which is changed by the mount watcher
+lustreLock = threading.Lock()
+
+# capacity (statvfs) of the mount points in worker threads
+capacity = False
+capacityTimeout = 2 # seconds to wait for the statvfs calls of a read
+
+# mount point -> [worker thread, (time, statvfs result) of the last successful call]
+capacityInfo = {}
+
+# instance name -> mount point (set by _getMatchingInstances)
+instanceMounts = {}
+
+# mount point -> instance name (set by _resolveMountInstances)
+mountInstances = {}
 ### END: global variables ###
 
+"""
+Data of a monitored Lustre instance.
+"""
+class _LustreInstance(object):
+  __slots__ = ('name', 'statsFile', 'fsname', 'previous', 'totals', 'timePrev', 'template', 'extentsPrev')
+
+  def __init__(self, name, statsFile):
+    self.name = name
+    self.statsFile = statsFile         # full path to the Lustre stats file
+    self.fsname = name.split('-',1)[0] # name of file system, e.g. scratch
+    self.previous = {}                 # last metric values
+    self.totals = {}                   # monotonic counters over resets (deriveValues)
+    self.timePrev = 0                  # time stamp of the last metric values
+    self.template = None               # multi-value list (multiValue)
+    self.extentsPrev = None            # last extents_stats histogram (histograms)
+
 """
 Check if one of the default search paths exists and set it as Lustre instances
 path. This functions assumes that only one path exists and takes the first path
@@ -92,11 +251,181 @@ def _setLustrePath():
       collectd.info("lustre plugin: Use Lustre path '%s'" % (searchPath,) )
       return
 
+"""
+Read the Lustre mounts from /proc/self/mountinfo. 
+Return a list of (mount point, file system name) or None, if the file cannot 
+be read. The source of a Lustre mount is '<MGS NIDs>:/<fsname>[/<subdirectory>]'.
+"""
+def _getLustreMounts():
+  try:
+    with open(MOUNTINFO_PATH, 'rb') as f:
+      lines = f.readlines()
+  except IOError as ioe:
+    collectd.info("lustre plugin: Cannot read %s (%s)" % (MOUNTINFO_PATH, repr(ioe)))
+    return None
+
+  mounts = []
+  for line in lines:
+    # <id> <parent> <dev> <root> <mount point> <options> [<optional> ...] - <type> <source> <super options>
+    fields = line.split()
+    try:
+      sep = fields.index(b'-', 6)
+    except ValueError:
+      continue
+
+    if len(fields) < sep + 3 or fields[sep + 1] != b'lustre':
+      continue
+
+    mount = _decodeMountField(fields[4])
+    fsname = _decodeMountField(fields[sep + 2]).rsplit(':/', 1)[-1].split('/', 1)[0]
+    mounts.append((mount, fsname))
+
+  return mounts
+
+"""
+Decode a field of the mount table. Special characters are octal-escaped (e.g. 
+'\\040' for a space), other bytes are in the file system encoding.
+"""
+def _decodeMountField(field):
+  field = re.sub(b'\\\\([0-7]{3})', lambda m: bytes((int(m.group(1), 8),)), field)
+  return os.fsdecode(field)
+
+"""
+Get the Lustre instance of a mount point with the ioctl of llapi_getname() 
+on the mount root. 
+Return None, if it cannot be determined.
+"""
+def _getInstanceOfMount(mount):
+  try:
+    fd = os.open(mount, os.O_RDONLY | os.O_DIRECTORY | os.O_NONBLOCK)
+  except OSError as ex:
+    collectd.info("lustre plugin: Cannot open mount %s (%s)" % (mount, repr(ex)))
+    return None
+
+  try:
+    buf = fcntl.ioctl(fd, OBD_IOC_GETDTNAME, bytes(MAX_OBD_NAME))
+  except (IOError, OSError) as ex:
+    collectd.info("lustre plugin: Cannot get the Lustre name of %s (%s)" % (mount, repr(ex)))
+    return None
+  finally:
+    os.close(fd)
+
+  # <fsname>-clilov-<superblock> -> <fsname>-<superblock>
+  name = buf.split(b'\0', 1)[0].decode('utf-8', 'replace')
+  if len(name) <= 24:
+    return None
+
+  return '%s-%s' % (name[:-24], name[-16:])
+
+"""
+Determine the Lustre instances of the given mount points and store them in 
+mountInstances. Mounts, which cannot be resolved with the ioctl, are resolved 
+with a single "lfs getname" call. Does not need the Lustre lock.
+"""
+def _resolveMountInstances(mounts):
+  resolved = {}
+  missing = []
+  for mount in mounts:
+    instance = _getInstanceOfMount(mount)
+    if instance is None:
+      missing.append(mount)
+    else:
+      resolved[mount] = instance
+
+  if missing:
+    try:
+      p = Popen(['lfs', 'getname'], stdout=PIPE, stderr=PIPE)
+      stdout, stderr = p.communicate()
+    except OSError as ex:
+      collectd.info("lustre plugin: Error launching 'lfs getname': %s" % (repr(ex),))
+      stdout = b''
+
+    # <instance> <mount point>
+    for line in os.fsdecode(stdout).splitlines():
+      larray = line.split(None, 1)
+      if len(larray) == 2 and larray[1] in missing:
+        resolved[larray[1]] = larray[0]
+
+  for mount in mounts:
+    if mount in resolved:
+      mountInstances[mount] = resolved[mount]
+    else:
+      mountInstances.pop(mount, None)
+
+  return resolved
+
+"""
+Select the relevant mount per file system name: the configured mounts (see
+fsname_and_mount) or the root mount (shortest mount point).
+Return a dict of file system name -> mount point.
+"""
+def _selectMounts(mounts):
+  fs_name_mount_map = {}
+
+  for fs_mount, fsname in mounts:
+    # if configuration provides file system names together with relative mount points
+    if confFsNameMountList is not None:
+      for fsNameMount in confFsNameMountList:
+        conf_fsname, conf_mount = fsNameMount.split(":", 1)
+        if (conf_fsname == '*' or conf_fsname == fsname) and fs_mount.endswith(conf_mount):
+          fs_name_mount_map[fsname] = fs_mount
+    elif fsname not in fs_name_mount_map or len(fs_mount) < len(fs_name_mount_map[fsname]):
+      fs_name_mount_map[fsname] = fs_mount
+
+  return fs_name_mount_map
+
+"""
+Determine the Lustre instances of the relevant mounts (see _selectMounts) 
+from /proc/self/mountinfo. The instance name (<fsname>-<superblock>) is not 
+part of the mount information. Hence, only if a file system has several 
+instances, its relevant mount is resolved (see _resolveMountInstances), unless 
+the mount watcher resolved it already. Falls back to "lfs getname" for all 
+mounts, if the mounts cannot be read.
+"""
+def _getMatchingInstances(instances):
+  mounts = _getLustreMounts()
+  if mounts is None:
+    return _getMatchingInstancesLfs()
+
+  fsInstances = {}
+  for instance in instances:
+    fsInstances.setdefault(instance.split('-', 1)[0], []).append(instance)
+
+  selected = _selectMounts(mounts)
+  unresolved = [fs_mount for fs_name, fs_mount in selected.items() 
+                if len(fsInstances.get(fs_name, [])) > 1 and fs_mount not in mountInstances]
+  if unresolved:
+    _resolveMountInstances(unresolved)
+
+  instanceMounts.clear()
+  fs_name_instance_map = {}
+  for fs_name, fs_mount in selected.items():
+    candidates = fsInstances.get(fs_name, [])
+    if len(candidates) == 1:
+      instance = candidates[0]
+    elif len(candidates) > 1:
+      instance = mountInstances.get(fs_mount)
+    else:
+      instance = None
+
+    if instance is None:
+      collectd.info("lustre plugin: No Lustre instance found for mount %s" % (fs_mount,))
+      continue
+
+    fs_name_instance_map[fs_name] = instance
+    instanceMounts[instance] = fs_mount
+    collectd.info("lustre plugin: Using mount point %s for file system %s" % (fs_mount, fs_name))
+
+  if len(fs_name_instance_map) == 0:
+    collectd.info("lustre plugin: No relevant file system mounts found!")
+
+  return list(fs_name_instance_map.values())
+
 # "lfs getname": 
 # scratch2-ffff984743280800 /lustre/scratch2
 # highiops-ffff9847f44be000 /lustre/ssd
 # scratch2-ffff98475d550000 /lustre/scratch2/ws
-def _getMatchingInstances():
+def _getMatchingInstancesLfs():
   cmd = 'lfs getname'
 
   try:
@@ -156,10 +485,12 @@ def _getMatchingInstances():
         fs_name_mount_map[fsname] = fs_mount
         fs_name_instance_map[fsname] = fs_instance
 
+  instanceMounts.clear()
   if len(fs_name_mount_map) == 0:
     collectd.info("lustre plugin: No relevant file system mounts found!")
   else:
     for fs_name in fs_name_mount_map:
+      instanceMounts[fs_name_instance_map[fs_name]] = fs_name_mount_map[fs_name]
       collectd.info("lustre plugin: Using mount point %s for file system %s" % (fs_name_mount_map[fs_name], fs_name))
 
   return fs_name_instance_map.values()
@@ -183,32 +514,23 @@ def _haveMultipleFsInstances(instances):
   return False
 
 """
-Return a list of Lustre instance paths. Requires Lustre path to be set. 
+Return a list of Lustre instances (directories in the Lustre path). Requires 
+Lustre path to be set. 
 """
 def _getAllLustreInstances():
   if lustrePath is None:
     collectd.error("lustre plugin: Lustre path is not set!")
     return []
-  # find file systems
-  #cmd = 'find ' + lustrePath + '* -maxdepth 0 -type d 2>/dev/null'
-  #cmd = 'ls -d ' + lustrePath + '*' # list content of lustrePath with full path
-  cmd = 'ls ' + lustrePath # list content of lustrePath
+
   try:
-    p = subprocess.Popen( cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE )
-    stdout, stderr = p.communicate()
-  except subprocess.CalledProcessError as e:
-    collectd.info("lustre plugin: %s error launching: %s; skipping" % (repr(e), cmd))
+    lustreInstances = [entry.name for entry in os.scandir(lustrePath) if entry.is_dir()]
+  except OSError as ex:
+    collectd.info("lustre plugin: Cannot list %s (%s)" % (lustrePath, repr(ex)))
     return []
-  else:
-    stdout= stdout.decode('utf-8')
 
-  if stdout == '':
-    collectd.info("lustre plugin: No file systems found: %s" % (cmd,))
-    return []
+  if len(lustreInstances) == 0:
+    collectd.info("lustre plugin: No file systems found in %s" % (lustrePath,))
 
-  #collectd.info("lustre plugin: Found Lustre instance paths: %s" % (stdout,))
-  lustreInstances = stdout.split('\n')
-  lustreInstances.remove("") # remove empty lines
   return lustreInstances
 
 """
@@ -232,84 +554,509 @@ def _setLustreInstances():
     # if we have multiple Lustre instances per file system, determine the 
     # instances that should be monitored
     if _haveMultipleFsInstances(lustreInstances):
-      lustreInstances = _getMatchingInstances()
+      lustreInstances = _getMatchingInstances(lustreInstances)
+      return
+
+  # determine only the mount points of the instances
+  if capacity:
+    _getMatchingInstances(lustreInstances)
 
 """
-Setup the Lustre instance paths, where stats files are located.
+Setup the Lustre instance paths, where stats files are located. New instances
+are added (with their first values), instances that are not monitored any 
+more are removed.
 """
 def _setupLustreFiles():
-  global fsInfo
-  fsInfo = []
+  monitored = set(lustreInstances)
+  _removeInstances([name for name in instances if name not in monitored])
 
-  for fsInstance in lustreInstances:    
-    fsName = fsInstance.split('-',1)[0]
+  newInstances = []
+  for fsInstance in lustreInstances:
+    if fsInstance in instances:
+      continue
 
     collectd.info("lustre plugin: Collect data for '%s'" % (fsInstance,))
 
-    fsInfo.append( lustrePath + fsInstance + '/stats' ) # full path to the Lustre stats file
-    fsInfo.append( fsName ) # name of file system, e.g. scratch
+    instance = _LustreInstance(fsInstance, lustrePath + fsInstance + '/stats')
+    instances[fsInstance] = instance
+    newInstances.append(instance)
 
-    # append array entry for lustre offset dictionary
-    fsInfo.append( {} )
-
-  #collectd.info("lustre plugin: Found %d file systems" % (len(fsInfo) / FS_ENTRIES,))
+  if targetStats or histograms:
+    _setupTargetFiles()
 
   # gather first/prev values
-  if len(fsInfo) > 0:
-    _setPrevValues()
+  if len(instances) > 0:
+    _setPrevValues(newInstances)
   else:
     global enabled
     enabled = False
     collectd.info("lustre plugin: No file systems found, Disable plugin for %d reads." % (checkSourcesInterval,) )
 
-  return len(fsInfo)
+  return len(instances)
+
+"""
+Find the OSC and MDC directories of the monitored Lustre instances. Their 
+names are <fsname>-<target>-<osc|mdc>-<instance suffix>.
+"""
+def _setupTargetFiles():
+  global targetInfo
+  suffixes = set('-' + instance.split('-', 1)[1] for instance in lustreInstances if '-' in instance)
+
+  targets = {}
+  for searchPath in DEFAULT_TARGET_SEARCH_PATHS:
+    for targetType, fileNames in TARGET_FILES.items():
+      try:
+        entries = list(os.scandir(searchPath + targetType))
+      except OSError:
+        continue
+
+      for entry in entries:
+        parts = entry.name.split('-')
+        if len(parts) < 4 or '-' + parts[-1] not in suffixes or not entry.is_dir():
+          continue
+
+        info = targets.get(entry.name)
+        if info is None:
+          # keep the last values of targets, which are already monitored
+          old = targetInfo.get(entry.name)
+          info = [parts[0], parts[1], {}] + (old[3:] if old else [{}, 0, None, None])
+          targets[entry.name] = info
+
+        for fileName in fileNames:
+          if (fileName == 'rpc_stats' and not histograms) or (fileName != 'rpc_stats' and not targetStats):
+            continue
+          path = os.path.join(entry.path, fileName)
+          if fileName not in info[2] and os.path.isfile(path):
+            info[2][fileName] = path
+
+  # skip targets without files to read
+  targetInfo = dict((name, info) for name, info in targets.items() if info[2])
+  collectd.info("lustre plugin: Collect statistics of %d targets" % (len(targetInfo),))
+
+"""
+Parse a target stats or md_stats file. 
+Return a dictionary of counters (number of samples and for read/write bytes the 
+number of bytes).
+"""
+def _parseTargetStats(finput):
+  counters = {}
+  for line in finput.splitlines():
+    linelist = line.split(None, 7)
+    if len(linelist) < 2 or linelist[0] in ('snapshot_time', 'start_time', 'elapsed_time'):
+      continue
+    try:
+      if linelist[0] == 'read_bytes' or linelist[0] == 'write_bytes':
+        op = linelist[0][:-6]
+        counters[op + '_requests'] = float(linelist[1])
+        counters[op + '_bw'] = float(linelist[6])
+      elif linelist[0] == 'req_waittime':
+        counters['rpcs'] = float(linelist[1])
+      else:
+        counters[linelist[0]] = float(linelist[1])
+    except (IndexError, ValueError):
+      continue
+
+  return counters
+
+"""
+Parse the import file of a target (YAML). 
+Return a dictionary with the current values (connection state, RPCs in 
+flight, timeouts and average wait time in microseconds).
+"""
+def _parseTargetImport(finput):
+  values = {}
+  for line in finput.splitlines():
+    key, sep, value = line.strip().partition(':')
+    if not sep:
+      continue
+    value = value.split()
+    if key == 'state' and value:
+      values['connected'] = 1.0 if value[0] == 'FULL' else 0.0
+    elif key in ('inflight', 'timeouts', 'avg_waittime') and value:
+      try:
+        values[key] = float(value[0])
+      except ValueError:
+        pass
+
+  return values
+
+"""
+Read and parse the files of a target (runs in the target reader threads).
+Return the target directory name, the counters and the current values.
+"""
+def _readTarget(name, files):
+  counters = {}
+  values = {}
+  hist = None
+  for fileName, path in files.items():
+    try:
+      with open(path, 'r') as f:
+        finput = f.read()
+    except IOError:
+      continue
+
+    if fileName == 'import':
+      values.update(_parseTargetImport(finput))
+    elif fileName == 'rpc_stats':
+      hist = _parseRpcStats(finput)
+    else:
+      counters.update(_parseTargetStats(finput))
+
+  return name, counters, values, hist
+
+"""
+Get the bucket of a histogram value (power of two) for the given histogram type.
+"""
+def _histBucket(histType, value):
+  if histType == HIST_RPC_PAGES:
+    bucket = value.bit_length() - 1 # 1 page: 0, 2 pages: 1, ...
+  elif histType == HIST_RPC_FLIGHT:
+    bucket = value.bit_length()     # 0: 0, 1: 1, 2-3: 2, ...
+  else:
+    bucket = (value // 4096).bit_length() # extent lower bound in bytes
+  return max(0, min(bucket, HIST_BUCKETS[histType] - 1))
+
+def _newHist(histTypes):
+  return dict((histType, {'read': [0] * HIST_BUCKETS[histType], 'write': [0] * HIST_BUCKETS[histType]}) 
+              for histType in histTypes)
+
+"""
+Parse the histograms of pages per RPC and RPCs in flight of an rpc_stats file:
+                        read                    write
+pages per rpc         rpcs   % cum % |       rpcs   % cum %
+1:                       0   0   0   |          0   0   0
+Return a dict of histogram type -> {'read': buckets, 'write': buckets}.
+"""
+def _parseRpcStats(finput):
+  hist = _newHist(RPC_STATS_SECTIONS.values())
+  section = None
+  for line in finput.splitlines():
+    if '|' not in line:
+      continue
+
+    key, sep, rest = line.partition(':')
+    if not sep:
+      # header line of a section
+      section = None
+      for header, histType in RPC_STATS_SECTIONS.items():
+        if line.startswith(header):
+          section = histType
+      continue
+
+    if section is None:
+      continue
+
+    readPart, _, writePart = rest.partition('|')
+    try:
+      bucket = _histBucket(section, int(key))
+      hist[section]['read'][bucket] += int(readPart.split()[0])
+      hist[section]['write'][bucket] += int(writePart.split()[0])
+    except (ValueError, IndexError):
+      continue
+
+  return hist
+
+"""
+Parse the histogram of an extents_stats file:
+      extents            calls    % cum%  |  calls    % cum%
+   0K -   4K :             0    0    0   |      0    0    0
+Return a dict of histogram type -> {'read': buckets, 'write': buckets}.
+"""
+def _parseExtentsStats(finput):
+  hist = _newHist([HIST_EXTENTS])
+  for line in finput.splitlines():
+    extent, sep, rest = line.partition(':')
+    if not sep or '|' not in rest or '-' not in extent:
+      continue
+
+    lower = extent.split('-', 1)[0].strip()
+    try:
+      size = int(lower[:-1]) * (1 << (10 * ' KMG'.index(lower[-1])))
+      readPart, _, writePart = rest.partition('|')
+      bucket = _histBucket(HIST_EXTENTS, size)
+      hist[HIST_EXTENTS]['read'][bucket] += int(readPart.split()[0])
+      hist[HIST_EXTENTS]['write'][bucket] += int(writePart.split()[0])
+    except (ValueError, IndexError):
+      continue
+
+  return hist
+
+"""
+Add the buckets of a histogram to the file system totals.
+"""
+def _addHist(totals, fsname, hist):
+  for histType, directions in hist.items():
+    total = totals.setdefault((fsname, histType), {'read': [0] * HIST_BUCKETS[histType], 
+                                                   'write': [0] * HIST_BUCKETS[histType]})
+    for direction, buckets in directions.items():
+      for idx, count in enumerate(buckets):
+        total[direction][idx] += count
+
+"""
+Return the increase of the histograms of a target or Lustre instance since the 
+previous histograms (None for the first read). If a bucket decreased (reset, 
+remount), the current counts are the increase.
+"""
+def _histDelta(previous, hist):
+  if previous is None:
+    return None
+
+  delta = {}
+  for histType, directions in hist.items():
+    if histType not in previous:
+      continue
+    delta[histType] = {}
+    for direction, buckets in directions.items():
+      prevBuckets = previous[histType][direction]
+      if any(cur < prev for cur, prev in zip(buckets, prevBuckets)):
+        delta[histType][direction] = list(buckets)
+      else:
+        delta[histType][direction] = [cur - prev for cur, prev in zip(buckets, prevBuckets)]
+
+  return delta
+
+"""
+Dispatch the increase of the histograms per file system (sum of the increases 
+of its targets or instances) as one value list per histogram type and direction 
+(e.g. type 'lustre_rpc_pages', type instance 'write'). Histograms without any 
+values are skipped.
+"""
+def _dispatchHistograms(totals, timestamp):
+  for (fsname, histType), total in totals.items():
+    for direction, buckets in total.items():
+      if max(buckets) == 0:
+        continue
+
+      vl = collectd.Values(type=histType)
+      vl.plugin = 'lustre_' + fsname
+      vl.type_instance = direction
+      vl.values = [float(count) for count in buckets]
+      vl.time = timestamp
+      vl.dispatch()
+
+"""
+Read the statistics of all targets in parallel and dispatch rates of the 
+counters and the current values with plugin 'lustre_<fsname>' and the target 
+name as plugin instance.
+"""
+def _collectTargets(timestamp):
+  global targetExecutor
+  if targetExecutor is None:
+    targetExecutor = ThreadPoolExecutor(max_workers=targetThreads)
+
+  # a hanging read blocks its worker, do not submit the target again, until 
+  # the read returned
+  futures = []
+  hanging = 0
+  for name, info in targetInfo.items():
+    if info[6] is not None and not info[6].done():
+      hanging += 1
+      continue
+    info[6] = targetExecutor.submit(_readTarget, name, info[2])
+    futures.append(info[6])
+
+  done, notDone = wait(futures, timeout=targetTimeout)
+  if notDone or hanging:
+    collectd.warning("lustre plugin: Skip %d targets (not read within %gs)" % (len(notDone) + hanging, targetTimeout))
+    for future in notDone:
+      future.cancel() # only possible, if the read has not started yet
+
+  histTotals = {}
+  for future in done:
+    name, counters, values, hist = future.result()
+    info = targetInfo.get(name)
+    if info is None:
+      continue
+
+    # sum the increase per target, targets that were skipped or added do not 
+    # change the totals
+    if hist:
+      delta = _histDelta(info[5], hist)
+      info[5] = hist
+      if delta:
+        _addHist(histTotals, info[0], delta)
+
+    # skipped targets have their own (longer) interval
+    fsname, target, files, previous, timePrev = info[:5]
+    interval = timestamp - timePrev
+    info[4] = timestamp
+    rates = {}
+    for metric, value in counters.items():
+      if metric in previous and timePrev > 0 and interval > 0:
+        rates[metric] = _counterDelta(value, previous[metric]) / interval
+      previous[metric] = value
+
+    _dispatchTarget(fsname, target, 'md_stats' in files, rates, values, timePrev > 0, timestamp)
+
+  return histTotals
+
+"""
+Dispatch the rates and current values of a target as one value list of type 
+'lustre_target' and for an MDC the rates of the metadata operations as one 
+value list of type 'lustre_mdc'. Counters, which are not in the stats file, 
+are zero (no operations yet). Rates are NaN for the first read.
+"""
+def _dispatchTarget(fsname, target, isMdc, rates, values, havePrevious, timestamp):
+  missing = 0.0 if havePrevious else float('nan')
+
+  vl = collectd.Values(type=TARGET_TYPE)
+  vl.plugin = 'lustre_' + fsname
+  vl.plugin_instance = target
+  vl.values = [float(values.get(field, float('nan'))) if field in TARGET_VALUE_FIELDS 
+               else float(rates.get(field, missing)) for field in TARGET_TYPE_FIELDS]
+  vl.time = timestamp
+  vl.dispatch()
+
+  if isMdc:
+    vl = collectd.Values(type=MDC_TYPE)
+    vl.plugin = 'lustre_' + fsname
+    vl.plugin_instance = target
+    vl.values = [float(rates.get(field, missing)) for field in MDC_TYPE_FIELDS]
+    vl.time = timestamp
+    vl.dispatch()
+
+"""
+Get the integer value of a key in a job_stats line (e.g. '{ samples: 7, ...}')
+after position pos. Return None, if the key is not found.
+"""
+def _jobStatsField(line, key, pos):
+  start = line.find(key, pos)
+  if start < 0:
+    return None
+  start += len(key)
+
+  end = line.find(',', start)
+  brace = line.find('}', start)
+  if end < 0 or 0 <= brace < end:
+    end = brace
+  try:
+    return int(line[start:end])
+  except ValueError:
+    return None
+
+"""
+Parse a job_stats file line by line and add the counters of each job to the 
+given totals (job ID -> dict of counters). Only the number of samples and for
+read/write bytes the sum of bytes are parsed, without splitting whole lines:
+- job_id:          1234
+  snapshot_time:   1510000000
+  read_bytes:      { samples: 7, unit: bytes, min: 4096, max: 1048576, sum: 2101248 }
+  getattr:         { samples: 0, unit:  reqs }
+"""
+def _parseJobStats(f, totals):
+  counters = None
+  for line in f:
+    pos = line.find(':')
+    if pos < 0:
+      continue
+
+    if line.startswith('- job_id', 0, 8):
+      counters = totals.setdefault(line[pos+1:].strip(), {})
+      continue
+
+    if counters is None:
+      continue
+
+    samples = _jobStatsField(line, 'samples:', pos)
+    if not samples:
+      continue
+
+    op = line[:pos].strip()
+    if op == 'read_bytes' or op == 'write_bytes':
+      op = op[:-6]
+      counters[op + '_bw'] = counters.get(op + '_bw', 0) + (_jobStatsField(line, 'sum:', pos) or 0)
+      op += '_requests'
+
+    counters[op] = counters.get(op, 0) + samples
+
+"""
+Read the job_stats files of all OSTs and MDTs on this server. Rates of the 
+jobs, which were active in the interval, are dispatched with plugin 
+'lustre_<fsname>_<ost|mdt>_jobs', the job ID as plugin instance and as meta 
+data 'jobid'. Counters of a job are summed up over the targets of a file system.
+"""
+def _collectJobStats():
+  global jobTimePrev
+  timestamp = time.time()
+
+  totals = {} # plugin name -> job ID -> counters
+  for kind, pattern in DEFAULT_JOB_STATS_PATTERNS.items():
+    for path in glob.glob(pattern):
+      fsname = os.path.basename(os.path.dirname(path)).split('-', 1)[0]
+      try:
+        with open(path, 'r', buffering=JOB_STATS_BUFFER_SIZE) as f:
+          _parseJobStats(f, totals.setdefault('lustre_%s_%s_jobs' % (fsname, kind), {}))
+      except (IOError, ValueError) as ex:
+        collectd.info("lustre plugin: Cannot read %s (%s)" % (path, repr(ex)))
+
+  interval = timestamp - jobTimePrev
+  for plugin, jobs in totals.items():
+    for jobid, counters in jobs.items():
+      info = jobInfo.get((plugin, jobid))
+      if info is None:
+        info = [{}, timestamp]
+        jobInfo[(plugin, jobid)] = info
+        # the first collection only sets the baseline, later a new job 
+        # started at zero during the interval
+        if jobTimePrev == 0:
+          info[0] = counters
+          continue
+
+      previous = info[0]
+      info[0] = counters
+      info[1] = timestamp
+      for metric, value in counters.items():
+        # counters of a job, which was removed from job_stats in between, start at zero
+        diff = _counterDelta(value, previous.get(metric, 0))
+        if diff > 0:
+          vl = collectd.Values(type='gauge')
+          vl.plugin = plugin
+          vl.plugin_instance = jobid
+          vl.meta = {'jobid': jobid}
+          vl.values = [float(diff) / interval]
+          vl.time = timestamp
+          vl.type_instance = metric
+          vl.dispatch()
+
+  # remove jobs, which have not been found for a while
+  for key in [key for key, info in jobInfo.items() if timestamp - info[1] > jobExpire]:
+    del jobInfo[key]
+
+  jobTimePrev = timestamp
 
 """
-Remove Lustre instance from global list via index to the stats file path.
+Remove Lustre instances by name.
 """
-def _removeInstances(idxList):
-  for idx in idxList:
-    del fsInfo[idx:idx+FS_ENTRIES]
+def _removeInstances(names):
+  for name in names:
+    instances.pop(name, None)
         
 """
-Set initial values for each Lustre intsance to determine difference (increase).
+Set initial values for the given Lustre instances to determine difference (increase).
 """
-def _setPrevValues():
+def _setPrevValues(newInstances):
   global enabled
 
-  deleteList = None
-  for idx in range( 0, len(fsInfo)-1, FS_ENTRIES):
-    statsFile = fsInfo[ idx ]
-    
-    if not statsFile:
-      continue
-      
+  deleteList = []
+  for instance in newInstances:
     # add lustre stats offsets
     try:
-      f = open( statsFile, "r" )
+      f = open( instance.statsFile, "r" )
       finput = f.read()
       f.close()
     except IOError as ioe:
-      collectd.info( "lustre plugin: Cannot read from %s (%s)" % (statsFile, repr(ioe),))
+      collectd.info( "lustre plugin: Cannot read from %s (%s)" % (instance.statsFile, repr(ioe),))
       
       # add Lustre instance to delete list
-      if deleteList is None:
-        deleteList = [idx]
-      else:
-        deleteList.append(idx)
+      deleteList.append(instance.name)
       continue
     else:
-      enabled = True
-      stats_offsets = _parseLustreStats( finput )
-      fsInfo[ idx + POS_PREV_DATA ].update( stats_offsets )
+      instance.previous.update( _parseLustreStats( finput ) )
+      instance.timePrev = time.time()
 
-  if deleteList is not None:
-    _removeInstances(deleteList)
+  _removeInstances(deleteList)
 
-  # store timestamp of previous data
-  if enabled:
-    global timePrev
-    timePrev = time.time()
+  enabled = len(instances) > 0
         
 """
 Check if there are file system instances available, which are not monitored yet.
@@ -317,96 +1064,153 @@ Return True, if a new file system instance has been found.
 """
 def _haveNewFS():
   for instance in lustreInstances:
-    newFS=True
-    # mark the FS instance as not new, if it is in the current list
-    for idx in range( 0, len(fsInfo)-1, FS_ENTRIES):
-      # fsInfo provides the full paths with the instances at the end
-      if instance in fsInfo[ idx ]:
-        newFS = False
-        break
-    
-    if newFS:
+    if instance not in instances:
       collectd.info("lustre plugin: Found new Lustre instance %s!" % (instance,))
       return True
     
   return False
 
 """ 
-Check for the existence of the stats files and clean up global list of Lustre 
-instance data. Delete a Lustre instance instead of disable it, when mounting 
+Check for the existence of the stats files and remove Lustre instances without
+stats file. Delete a Lustre instance instead of disable it, when mounting 
 again the instance magic ID probably changes and we want to avoid long lists
 with many disabled instances that will never get enabled again.
 """
 def _checkLustreStatsFiles():
-  deleteList = None
-  # iterate over file system info list in steps of FS_ENTRIES
-  for idx in range( 0, len(fsInfo)-1, FS_ENTRIES):
+  deleteList = []
+  for instance in instances.values():
     # disable file system, if stats file does not exist
-    if not os.path.isfile(fsInfo[idx]):
-      collectd.warning("lustre plugin: Stop reading from %s (file not found)." % (fsInfo[idx],))
-      if deleteList is None:
-        deleteList = [idx]
-      else:
-        deleteList.append(idx)
+    if not os.path.isfile(instance.statsFile):
+      collectd.warning("lustre plugin: Stop reading from %s (file not found)." % (instance.statsFile,))
+      deleteList.append(instance.name)
 
-  if deleteList is not None:
-    _removeInstances(deleteList)
+  _removeInstances(deleteList)
+
+"""
+Compile the parser for the selected operations of the stats file. Lines have 
+the format '<op> <count> samples [<unit>] [<min> <max> <sum> [<sumsq>]]'. Lines
+of other operations are skipped by the regular expression without splitting.
+"""
+def _compileStatsParser():
+  global statsPattern
+  if '*' in statsOps:
+    ops = r'\w+'
+  else:
+    ops = '|'.join(re.escape(op) for op in statsOps)
+  statsPattern = re.compile(r'^(%s)\s+(\d+) samples \[(\w+)\](?:\s+\d+\s+\d+\s+(\d+))?' % (ops,), re.M)
 
 """
 Parse the lustre stats file.
 Return dictionary with metric names (key) and value (value)
 """
 def _parseLustreStats(finput):
+  if statsPattern is None:
+    _compileStatsParser()
+
   lustrestat = {}
-  try:
-    for line in filter( None, finput.split('\n') ):
-      linelist = line.split() #re.split( "\s+", line ) #split is faster than re.split
-      if linelist[0] == "read_bytes":
-        lustrestat["read_requests"] = float(linelist[1]) 
-        lustrestat["read_bw"] = float(linelist[6])
-      elif linelist[0] == "write_bytes":
-        lustrestat["write_requests"] = float(linelist[1]) 
-        lustrestat["write_bw"] = float(linelist[6])
-      elif linelist[0] in KEY_MAPPING:
-        lustrestat[linelist[0]] = float(linelist[1])
-  except IndexError:
-    collectd.error("lustre plugin: Index error in parsing lustre stats")
+  for op, count, unit, total in statsPattern.findall(finput):
+    if op == "read_bytes" or op == "write_bytes":
+      op = op[:-6]
+      lustrestat[op + "_requests"] = int(count)
+      if total:
+        lustrestat[op + "_bw"] = int(total)
+    else:
+      lustrestat[op] = int(count)
+      # sum of latencies in microseconds (after the count of the operation)
+      if statsLatency and total and unit.startswith('usec'):
+        lustrestat[op + LATENCY_SUFFIX] = int(total)
 
   return lustrestat
 
 """
-Dispatch acquired metrics.
+Return the increase of a counter since the previous value. After a reset (e.g. 
+'lctl set_param llite.*.stats=clear' or a remount with the same name) the 
+counter started again at zero, hence the current value is the increase.
 """
-def _dispatchLustreMetrics(fsIdx, lustreMetrics, timestamp): 
-    fsname   = fsInfo[ fsIdx + POS_FSNAME ]
-    previous = fsInfo[ fsIdx + POS_PREV_DATA ]
+def _counterDelta(current, previous):
+  if current >= previous:
+    return current - previous
+  elif previous >= COUNTER_WRAP_THRESHOLD:
+    return current + COUNTER_MAX - previous
+  else:
+    return current
 
-    interval = timestamp - timePrev
+"""
+Dispatch acquired metrics. Operations, which are not in the stats file, have 
+not been executed yet (count 0).
+"""
+def _dispatchLustreMetrics(instance, lustreMetrics, timestamp): 
+    fsname   = instance.fsname
+    previous = instance.previous
+    totals   = instance.totals
+
+    havePrevious = instance.timePrev > 0
+    interval = timestamp - instance.timePrev
+    instance.timePrev = timestamp
+    if interval <= 0 and not deriveValues:
+      return
+
+    deltas = {} # increase of the operation counts for the latencies
+    values = {} # values of the multi-value type
+    reset = False
 
     # for all lustre metrics (iterate over keys)
-    for metric in lustreMetrics:      
-      ### determine bandwidth manually ###
-      # check for a previous value
-      if metric in previous:
-          currValue = lustreMetrics[ metric ] - previous[ metric ]
-          #self.log.debug( "Current value: %d (%d - %d)", currValue, lustreMetrics[ metric ], previous[ metric ] )
+    for metric, current in lustreMetrics.items():
+      prevValue = previous.get(metric, 0)
+      previous[metric] = current
+      if current < prevValue:
+        reset = True
+      delta = _counterDelta(current, prevValue)
+
+      if metric.endswith(LATENCY_SUFFIX):
+        # average latency of the operations in the interval
+        numOps = deltas.get(metric[:-len(LATENCY_SUFFIX)], 0)
+        if numOps <= 0:
+          continue
+        value = float(delta) / numOps
+        valueType = 'gauge'
+      elif deriveValues:
+        # the rate is determined by the consumer (e.g. collectd cache or writer)
+        deltas[metric] = delta
+        value = totals.get(metric, prevValue) + delta
+        totals[metric] = value
+        valueType = 'derive'
       else:
-          currValue = lustreMetrics[ metric ]
-          #self.log.debug( "Current value (no offset): %d", currValue )
+        deltas[metric] = delta
+        value = float(delta) / interval
+        valueType = 'gauge'
 
-      # set previous value
-      previous[ metric ] = lustreMetrics[ metric ]
-      
-      if currValue >= 0:
-        # TODO: change to derive type?
-        vl = collectd.Values(type='gauge')
+      if multiValue and metric in LUSTRE_TYPE_FIELDS:
+        values[metric] = value
+      else:
+        vl = collectd.Values(type=valueType)
         vl.plugin='lustre_' + fsname
-        vl.values = [float(currValue) / float(interval)]
+        vl.values = [value]
         vl.time = timestamp
         vl.type_instance = metric
         vl.dispatch()
+
+    if reset:
+      collectd.info("lustre plugin: Counters of %s have been reset." % (instance.name,))
+      # operations not listed after the reset start again at zero
+      for metric in previous:
+        if metric not in lustreMetrics:
+          previous[metric] = 0
+
+    # one value list per file system, operations without counter did not occur 
+    # yet (0), rates of the first sample are unknown (NaN)
+    if multiValue:
+      vl = instance.template
+      if vl is None:
+        vl = collectd.Values(type=LUSTRE_DERIVE_TYPE if deriveValues else LUSTRE_TYPE)
+        vl.plugin = 'lustre_' + fsname
+        instance.template = vl
+      if deriveValues:
+        vl.values = [totals.get(field, 0) for field in LUSTRE_TYPE_FIELDS]
       else:
-        collectd.debug("lustre plugin: %d: bandwidth < 0 (current: %f, previous available? %s" % (timestamp, lustreMetrics[ metric ], metric in previous))
+        vl.values = [values.get(field, 0.0) if havePrevious else float('nan') for field in LUSTRE_TYPE_FIELDS]
+      vl.time = timestamp
+      vl.dispatch()
 
 """
 Check for Lustre files. Return True, if a new file instance was found.
@@ -429,6 +1233,209 @@ def _run_check():
 
   return ret
 
+"""
+Wait for changes of the mount table (poll on /proc/self/mountinfo signals 
+POLLPRI) and check the Lustre files, if the Lustre mounts changed.
+"""
+def _watchMounts():
+  try:
+    f = open(MOUNTINFO_PATH, 'r')
+    f.read()
+    poller = select.poll()
+    poller.register(f, select.POLLPRI | select.POLLERR)
+  except (IOError, OSError) as ex:
+    collectd.error("lustre plugin: Cannot watch %s (%s)" % (MOUNTINFO_PATH, repr(ex)))
+    return
+
+  mounts = _getLustreMounts()
+  while watcherRunning:
+    # time out to notice the end of the plugin
+    if not poller.poll(1000):
+      continue
+
+    # mount and unmount often come in bursts
+    time.sleep(MOUNT_SETTLE_TIME)
+    f.seek(0)
+    f.read()
+
+    newMounts = _getLustreMounts()
+    if newMounts == mounts:
+      continue
+    mounts = newMounts
+
+    # resolve the instances before the check, which holds the Lustre lock
+    current = [mount for mount, fsname in mounts or []]
+    for mount in list(mountInstances):
+      if mount not in current:
+        del mountInstances[mount]
+    _resolveMountInstances(current)
+
+    collectd.info("lustre plugin: Lustre mounts changed. Check Lustre files.")
+    with lustreLock:
+      _run_check()
+
+  f.close()
+
+"""
+Start the mount watcher thread.
+"""
+def _startWatcher():
+  global watcherThread
+  global watcherRunning
+  if not hasattr(select, 'poll') or not os.path.exists(MOUNTINFO_PATH):
+    collectd.info("lustre plugin: Cannot watch mounts. Use recheck_limit for periodic checks.")
+    return
+
+  watcherRunning = True
+  watcherThread = threading.Thread(target=_watchMounts, name='lustre_bw mounts')
+  watcherThread.daemon = True
+  watcherThread.start()
+
+"""
+Read the stats files of all monitored instances every samplePeriod seconds and
+store the bandwidths between consecutive samples.
+"""
+def _sampleLoop():
+  while not samplerStop.is_set():
+    start = time.monotonic()
+    with lustreLock:
+      files = [(instance.statsFile, instance.fsname) for instance in instances.values()]
+
+    for statsFile, fsname in files:
+      try:
+        with open(statsFile, 'r') as f:
+          finput = f.read()
+      except IOError:
+        continue
+
+      now = time.time()
+      stats = _parseLustreStats(finput)
+      with samplerLock:
+        entry = samples.get(statsFile)
+        if entry is None:
+          entry = [fsname, None, dict((metric, []) for metric in SAMPLE_METRICS)]
+          samples[statsFile] = entry
+        elif entry[1] is not None:
+          prevTime, prevStats = entry[1]
+          for metric in SAMPLE_METRICS:
+            if metric in stats and metric in prevStats and now > prevTime:
+              diff = _counterDelta(stats[metric], prevStats[metric])
+              entry[2][metric].append(diff / (now - prevTime))
+        entry[1] = (now, stats)
+
+    samplerStop.wait(max(0, samplePeriod - (time.monotonic() - start)))
+
+"""
+Dispatch min, max, mean and 95th percentile of the sampled bandwidths of the 
+interval per file system (e.g. 'read_bw_max') and start the next interval.
+"""
+def _dispatchSampleSummaries(timestamp):
+  with samplerLock:
+    current = set(instance.statsFile for instance in instances.values())
+    for statsFile in list(samples):
+      if statsFile not in current:
+        del samples[statsFile]
+        continue
+
+      fsname, last, rates = samples[statsFile]
+      for metric, values in rates.items():
+        if not values:
+          continue
+        values.sort()
+        summary = {
+          'min': values[0],
+          'max': values[-1],
+          'mean': sum(values) / len(values),
+          'p95': values[max(0, int(math.ceil(0.95 * len(values))) - 1)]
+        }
+        for name, value in summary.items():
+          vl = collectd.Values(type='gauge')
+          vl.plugin = 'lustre_' + fsname
+          vl.values = [float(value)]
+          vl.time = timestamp
+          vl.type_instance = metric + '_' + name
+          vl.dispatch()
+        rates[metric] = []
+
+"""
+Start the high-frequency sampler thread.
+"""
+def _startSampler():
+  global samplerThread
+  samplerStop.clear()
+  samplerThread = threading.Thread(target=_sampleLoop, name='lustre_bw sampler')
+  samplerThread.daemon = True
+  samplerThread.start()
+  collectd.info("lustre plugin: Sample bandwidths every %gs" % (samplePeriod,))
+
+"""
+Call statvfs for a mount point (in a worker thread) and store the result.
+"""
+def _statMount(mount, entry):
+  try:
+    result = os.statvfs(mount)
+  except OSError as ex:
+    collectd.info("lustre plugin: statvfs of %s failed (%s)" % (mount, repr(ex)))
+    return
+
+  entry[1] = (time.time(), result)
+
+"""
+Collect the capacity of the given mount points (dict of file system name -> 
+mount point). Each statvfs call runs in its own thread, as it can hang for 
+minutes, if a target is not available. The read waits at most capacityTimeout 
+seconds. Mounts without a current result are dispatched with their last 
+result and marked as stale. A mount, whose call still hangs, gets no new 
+thread and is not waited for.
+"""
+def _collectCapacity(mounts):
+  start = time.time()
+  deadline = time.monotonic() + capacityTimeout
+
+  started = []
+  for fsname, mount in mounts.items():
+    entry = capacityInfo.get(mount)
+    if entry is None:
+      entry = [None, None]
+      capacityInfo[mount] = entry
+    elif entry[0] is not None and entry[0].is_alive():
+      continue
+
+    entry[0] = threading.Thread(target=_statMount, args=(mount, entry), name='lustre_bw statvfs')
+    entry[0].daemon = True
+    entry[0].start()
+    started.append((mount, entry[0]))
+
+  for mount, thread in started:
+    thread.join(max(0, deadline - time.monotonic()))
+    if thread.is_alive():
+      collectd.warning("lustre plugin: statvfs of %s did not finish within %s seconds." % (mount, capacityTimeout))
+
+  timestamp = time.time()
+  for fsname, mount in mounts.items():
+    thread, result = capacityInfo[mount]
+    stale = result is None or result[0] < start
+    if result is not None:
+      st = result[1]
+      _dispatchCapacityValue(fsname, 'df_complex', 'free', st.f_bavail * st.f_frsize, timestamp)
+      _dispatchCapacityValue(fsname, 'df_complex', 'used', (st.f_blocks - st.f_bfree) * st.f_frsize, timestamp)
+      _dispatchCapacityValue(fsname, 'df_inodes', 'free', st.f_ffree, timestamp)
+      _dispatchCapacityValue(fsname, 'df_inodes', 'used', st.f_files - st.f_ffree, timestamp)
+    _dispatchCapacityValue(fsname, 'gauge', 'capacity_stale', 1 if stale else 0, timestamp)
+
+  # forget mounts, which are not monitored any more
+  for mount in [mount for mount, entry in capacityInfo.items() 
+                if mount not in mounts.values() and not entry[0].is_alive()]:
+    del capacityInfo[mount]
+
+def _dispatchCapacityValue(fsname, valueType, typeInstance, value, timestamp):
+  vl = collectd.Values(type=valueType)
+  vl.plugin = 'lustre_' + fsname
+  vl.type_instance = typeInstance
+  vl.values = [value]
+  vl.time = timestamp
+  vl.dispatch()
+
 """
 Collectd configuration callback
 """
@@ -454,6 +1461,50 @@ def lustre_plugin_config(config):
         checkSourcesInterval = int(value.values[0])
         if checkSourcesInterval > 0:
           collectd.info("lustre plugin: Check for available Lustre file systems every %d reads" % (checkSourcesInterval,))
+      elif value.key == 'target_stats':
+        global targetStats
+        targetStats = value.values[0] in (True, 'true', 'True', '1')
+      elif value.key == 'target_threads':
+        global targetThreads
+        targetThreads = int(value.values[0])
+      elif value.key == 'target_timeout':
+        global targetTimeout
+        targetTimeout = float(value.values[0])
+      elif value.key == 'job_stats':
+        global jobStats
+        jobStats = value.values[0] in (True, 'true', 'True', '1')
+      elif value.key == 'job_expire':
+        global jobExpire
+        jobExpire = float(value.values[0])
+      elif value.key == 'sample_period':
+        global samplePeriod
+        samplePeriod = float(value.values[0])
+      elif value.key == 'metrics':
+        # operations of the stats file, e.g. metrics "read_bytes" "write_bytes" "open" "getattr" or "*"
+        global statsOps
+        statsOps = list(value.values)
+        _compileStatsParser()
+      elif value.key == 'latency':
+        global statsLatency
+        statsLatency = value.values[0] in (True, 'true', 'True', '1')
+      elif value.key == 'multi_value':
+        global multiValue
+        multiValue = value.values[0] in (True, 'true', 'True', '1')
+      elif value.key == 'derive':
+        global deriveValues
+        deriveValues = value.values[0] in (True, 'true', 'True', '1')
+      elif value.key == 'histograms':
+        global histograms
+        histograms = value.values[0] in (True, 'true', 'True', '1')
+      elif value.key == 'capacity':
+        global capacity
+        capacity = value.values[0] in (True, 'true', 'True', '1')
+      elif value.key == 'capacity_timeout':
+        global capacityTimeout
+        capacityTimeout = float(value.values[0])
+      elif value.key == 'watch_mounts':
+        global watchMounts
+        watchMounts = value.values[0] in (True, 'true', 'True', '1')
       
 """
 Collectd plugin initialization callback.
@@ -469,19 +1520,56 @@ def lustre_plugin_initialize():
   _setupLustreFiles()
   _checkLustreStatsFiles()
 
+  if watchMounts:
+    _startWatcher()
+
+  if samplePeriod > 0:
+    _startSampler()
+
+"""
+Collectd plugin shutdown callback. Stops the mount watcher.
+"""
+def lustre_plugin_shutdown():
+  global watcherRunning
+  watcherRunning = False
+  if watcherThread:
+    watcherThread.join(2)
+
+  if targetExecutor:
+    targetExecutor.shutdown(wait=False)
+
+  samplerStop.set()
+  if samplerThread:
+    samplerThread.join(2)
+
 
 """
 Read the Lustre stats files for all setup Lustre instances.
 """
 def lustre_plugin_read(data=None):
+  mounts = None
+  with lustreLock:
+    _read()
+    if capacity and enabled:
+      mounts = dict((instance.fsname, instanceMounts[instance.name])
+                    for instance in instances.values() if instance.name in instanceMounts)
+
+  # not blocked by the mount watcher, if a file system hangs
+  if mounts:
+    _collectCapacity(mounts)
+
+  if jobStats:
+    _collectJobStats()
+
+def _read():
   #self.log.debug( "Collect %d ? %d", num_reads, recheck_limit)
 
   # check for available file systems every #recheck_limit reads
   global numReads
   numReads += 1
   
-  # check for available file systems
-  if numReads == checkSourcesInterval:
+  # check for available file systems (not needed, if mount changes are watched)
+  if numReads == checkSourcesInterval and not watcherRunning:
     # check, if the Lustre setup changed
     if _run_check():
       return
@@ -489,40 +1577,49 @@ def lustre_plugin_read(data=None):
   if not enabled:
     return
 
-  #collectd.debug("lustre plugin: Collect for %d file systems" % (len(fsInfo) / FS_ENTRIES),)
+  #collectd.debug("lustre plugin: Collect for %d file systems" % (len(instances),))
 
   # get time stamp for all lustre metric values that we read
   timestamp = time.time()
 
-  # iterate over file system info list in steps of FS_ENTRIES (as we have FS_ENTRIES entries per file system)
-  #self.log.debug("[LustreCollector] %d, %d", len(self.fsInfo)-1, FS_ENTRIES)
-  deleteList = None
-  for idx in range( 0, len(fsInfo)-1, FS_ENTRIES):
-    statsFile = fsInfo[ idx ]
-    if not statsFile:
-      continue
-
-    #self.log.debug("[LustreCollector] Collect from lustre %s (idx: %d), %d metrics", fs, idx, len(self.fsInfo[idx+2]))
+  histTotals = {}
+  deleteList = []
+  for instance in instances.values():
     try:
-      f = open( statsFile, "r" )
+      f = open( instance.statsFile, "r" )
       finput = f.read()
       f.close()
     except IOError as ioe:
-      collectd.error("lustre plugin: Cannot read %s (%s). Stop reading!" % (statsFile, repr(ioe)))
-      if deleteList is None:
-        deleteList = [idx]
-      else:
-        deleteList.append(idx)
+      collectd.error("lustre plugin: Cannot read %s (%s). Stop reading!" % (instance.statsFile, repr(ioe)))
+      deleteList.append(instance.name)
     else:
       # parse the data into dictionary (key is metric name, value is metric value)
       lustrestat = _parseLustreStats( finput )
-      _dispatchLustreMetrics( idx, lustrestat, timestamp )
+      _dispatchLustreMetrics( instance, lustrestat, timestamp )
+
+    if histograms:
+      try:
+        with open(os.path.join(os.path.dirname(instance.statsFile), 'extents_stats'), 'r') as f:
+          hist = _parseExtentsStats(f.read())
+      except IOError:
+        pass
+      else:
+        delta = _histDelta(instance.extentsPrev, hist)
+        instance.extentsPrev = hist
+        if delta:
+          _addHist(histTotals, instance.fsname, delta)
+
+  _removeInstances(deleteList)
 
-  if deleteList is not None:
-    _removeInstances(deleteList)
+  if (targetStats or histograms) and targetInfo:
+    for (fsname, histType), total in _collectTargets(timestamp).items():
+      _addHist(histTotals, fsname, {histType: total})
 
-  global timePrev
-  timePrev = timestamp
+  if histTotals:
+    _dispatchHistograms(histTotals, timestamp)
+
+  if samplerThread:
+    _dispatchSampleSummaries(timestamp)
 
 """
 Handle notifications, e.g. trigger check and enable/disable reading.
@@ -535,7 +1632,8 @@ def lustre_plugin_notify(notification, data=None):
     global enabled
     if notification.message == "check":
       collectd.info("lustre plugin: Check Lustre files.")
-      _run_check()
+      with lustreLock:
+        _run_check()
     elif notification.message == "disable":
       collectd.info("lustre plugin: Disable reading")
       enabled = False
@@ -561,6 +1659,7 @@ if __name__ != "__main__":
   collectd.register_init(lustre_plugin_initialize)
   collectd.register_read(lustre_plugin_read)
   collectd.register_notification(lustre_plugin_notify)
+  collectd.register_shutdown(lustre_plugin_shutdown)
 else:
   # outside plugin just collect the info
 